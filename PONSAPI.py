@@ -4,16 +4,53 @@ import requests
 import os
 import re
 import json
+import hashlib
+import html
+import unicodedata
 import logging
+import time
 from datetime import datetime
-from collections import Counter
-import pandas as pd
+import shutil
+import tempfile
+import zipfile
+import struct
+import copy
+import pickle
+import csv
+import functools
+import itertools
+import random
+import sqlite3
+import posixpath
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
 from openpyxl import load_workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.worksheet.table import Table, TableStyleInfo
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.worksheet.table import Table
+
+# Optional Anki reader backends
+try:
+    from pyxlsb import open_workbook as open_xlsb_workbook
+except ImportError:
+    open_xlsb_workbook = None
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+# Optional columnar format for the Anki snapshot and the parquet result sink
+try:
+    import pyarrow
+    import pyarrow.feather as pyarrow_feather
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = None
 
 # Selector to choose the function to run
-# Options: "fetch", "process"
+# Options: "fetch", "process", "benchmark_readers", "expand_acronyms", "extract_paths", "profile_schema", "validate",
+# "query_facets"
 mode = "process"  # Default mode is set to "process"
 
 # Base directory for all file paths
@@ -25,66 +62,301 @@ output_directory = os.path.join(base_directory, "PONS json Files")
 concatenated_file_path = os.path.join(output_directory, "concatenated.json")
 query_parts_of_speech_json_path = os.path.join(base_directory, "Query Parts of Speech.json")
 flashcards_xlsm_path = os.path.join(base_directory, "Flashcards.xlsm")
+# Workbook the Anki sheet is read from; may also point to Flashcards.xlsb
+anki_workbook_path = flashcards_xlsm_path
+
+# Catalogue of the span/strong classes parsed out of PONS markup, and the parsed-corpus cache
+markup_catalogue_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Process.csv")
+parsed_corpus_path = os.path.join(output_directory, "concatenated.parsed.pickle")
+parsed_corpus_version = 1
+
+# Acronym expansion table (span class -> acronym -> title) and the "expand_acronyms" mode output
+acronyms_json_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Acronyms.json")
+expanded_file_path = os.path.join(output_directory, "concatenated.expanded.json")
+acronym_cache_size = 100000  # memoized fragments before the cache is reset
+
+# Path extraction (mode "extract_paths"): Process.csv-style paths evaluated over concatenated.json in one pass;
+# "[*]" matches every list item and ".*" every object key
+extract_path_expressions = [
+    "[*].data[*].hits[*].roms[*].headword_full",
+    "[*].data[*].hits[*].roms[*].arabs[*].header",
+]
+extracted_paths_path = os.path.join(output_directory, "extracted_paths.csv")
+
+# Corpus scans (profile_schema, validate): concatenated.json is streamed in shards handled by a process pool
+corpus_shard_size = 1000  # entries per shard
+corpus_workers = None  # worker processes; None uses every CPU, 1 scans in this process
+
+# Schema profiling (mode "profile_schema"): partial profiles of the shards are merged into one report
+# per generalized path
+schema_profile_path = os.path.join(output_directory, "schema_profile.json")
+schema_sample_size = 5  # reservoir-sampled example values kept per path
+
+# Corpus validation (mode "validate"): every stored response is classified (see VALIDATION_CATEGORIES);
+# queries in refetch_categories are written to refetch_list_path for the fetch mode
+validation_report_path = os.path.join(output_directory, "validation_report.json")
+refetch_list_path = os.path.join(output_directory, "refetch.txt")
+refetch_categories = ["http_error", "exception", "malformed_span"]
+validate_before_process = False  # run the validation at the start of every process run
+
+# Faceted rom index (mode "query_facets"): each named query maps facets (FACET_CLASSES) to a value,
+# a list of values (any of them), a "!value" to exclude, or None for roms without that facet
+facet_queries = {
+    "neuter nouns": {"wordclass": "noun", "genus": "neuter"},
+    "military nouns": {"wordclass": "noun", "topic": "military"},
+    "verbs without aspect": {"wordclass": "verb", "conjugation": None},
+    "not nouns or verbs": {"wordclass": ["!noun", "!verb"]},
+}
+facet_results_path = os.path.join(output_directory, "facet_results.csv")
+
+# Fetch only the queries listed in refetch_list_path and replace their entries in concatenated.json,
+# keeping every other stored response
+fetch_refetch_list = False
+
+# Incremental reconcile: fingerprints and results of the previous process run
+incremental_reconcile = True
+reconcile_state_path = os.path.join(output_directory, "reconcile_state.json")
+# Bump whenever matching logic or result columns change, so stale state is discarded
+reconcile_state_version = 10
+
+# Fuzzy matching (Level 5): maximum edit distance accepted by the BK-tree lookup
+fuzzy_max_distance = 2
+
+# Match strategies in the order they are tried; remove or reorder entries to tune the cascade
+match_strategy_order = [
+    "exact_wordclass",   # Level 1
+    "exact",             # Level 2
+    "partial",           # Level 3b-3e
+    "cutoff_wordclass",  # Level 4 with wordclass
+    "cutoff",            # Level 4
+    "inflected",         # Level 4b
+    "fuzzy",             # Level 5
+]
+
+# Anki sheet reader: "auto" (by extension: calamine if installed, else "xml" for .xlsx/.xlsm
+# and "pyxlsb" for .xlsb), or one of "xml", "openpyxl", "pyxlsb", "calamine"
+anki_reader_backend = "auto"
+# Timed reads per backend in "benchmark_readers" mode
+benchmark_repeats = 3
+
+# Snapshot of the projected Anki table, reused while the workbook's size, mtime and hash are unchanged
+anki_snapshot_enabled = True
+anki_snapshot_path = os.path.join(output_directory, "anki_snapshot")  # extension added per format
+anki_snapshot_version = 1
+
+# Outputs of process mode, fed from the same result stream; any of "xlsm", "csv", "jsonl", "parquet", "sqlite"
+result_sinks = ["xlsm"]
+results_csv_path = os.path.join(output_directory, "results.csv")
+results_jsonl_path = os.path.join(output_directory, "results.jsonl")
+results_parquet_path = os.path.join(output_directory, "results.parquet")  # requires pyarrow
+results_sqlite_path = os.path.join(output_directory, "results.sqlite")
+result_sink_batch_size = 10000
+
+# Compare results with the previous run (kept in the reconcile state) and write the differences
+results_diff_enabled = True
+results_diff_path = os.path.join(output_directory, "results_diff.jsonl")
+# Sinks that only receive rows added or changed since the previous run, e.g. ["csv", "sqlite"]
+delta_only_sinks = []
+
+# Write PONS results back into the Anki sheet (only cells whose value changes are rewritten)
+anki_writeback = False
+# Anki column -> result column copied into it
+anki_writeback_columns = {
+    "PONS Status 1": "PONS Status 1",
+    "PONS Status 2": "PONS Status 2",
+    "Hint": "Hint 1",
+    "Hint 2": "Hint 2",
+    "PONS en I.1": "PONS en I.1",
+    "PONS en I.2": "PONS en I.2",
+    "PONS en I.3": "PONS en I.3",
+    "PONS en I.4": "PONS en I.4",
+    "PONS en I.5": "PONS en I.5",
+    "PONS en II.1": "PONS en II.1",
+    "PONS en II.2": "PONS en II.2",
+    "PONS en II.3": "PONS en II.3",
+    "PONS en III.1": "PONS en III.1",
+    "PONS en III.2": "PONS en III.2",
+    "PONS en III.3": "PONS en III.3",
+    "PONS en III.4": "PONS en III.4",
+    "PONS en III.5": "PONS en III.5",
+    "PONS en IV.1": "PONS en IV.1",
+    "PONS en IV.2": "PONS en IV.2",
+    "PONS en V.1": "PONS en V.1",
+    "Imperfective Present": "Imperfective Present",
+    "Perfective Present": "Perfective Present",
+    "Adjective Masculine": "Adjective Masculine",
+    "Adjective Feminine": "Adjective Feminine",
+    "Adjective Neuter": "Adjective Neuter",
+    "Adjective Plural": "Adjective Plural",
+    "Noun Short Definite": "Noun Short Definite",
+    "Noun Long Definite": "Noun Long Definite",
+    "Noun Plural": "Noun Plural",
+    "Noun Numeral Plural": "Noun Numeral Plural",
+    "Noun Plural Definite": "Noun Plural Definite",
+}
+
+# How the Results sheet is written into Flashcards.xlsm:
+# "patch" replaces only the Results worksheet and table parts and copies every other part byte-for-byte,
+# "openpyxl" lets openpyxl re-save the whole workbook
+xlsm_write_mode = "patch"
+
+# Hint rendering, applied in batches to the hint columns of newly matched rows before they are written
+expand_hint_acronyms = False  # replace <acronym title="...">abbr</acronym> with its title
+strip_hint_html = True  # drop HTML tags and unescape entities, so Excel shows plain text
+# Replacement for the headword placeholder <strong class="tilde">...</strong>: "{}" stands for the
+# word itself, e.g. "~" or "[{}]"; None keeps the word unmarked
+hint_tilde_marker = None
+hint_render_cache_size = 50000  # rendered fragments kept in the LRU cache
+
+# Combining breve distinguishes й from и and must survive key normalization
+COMBINING_BREVE = "\u0306"
+# Vowels, and the fleeting vowels dropped before an ending (до̀бър -> добра)
+BULGARIAN_VOWELS = frozenset("аеиоуъюя")
+FLEETING_VOWELS = frozenset("ъе")
+
+# Number of hints a match carries (Hint 1, Hint 2)
+HINT_COUNT = 2
+
+# Per-field result columns; Bulgarian 2 gets the same columns with BULGARIAN_2_SUFFIX
+RESULT_FIELD_COLUMNS = [
+    "Match Level", "Matched Value", "Matched Key", "Cutoff Applied",
+    "Fuzzy Distance", "Hint 1", "Hint 2", "Match Detail"
+]
+RESULT_FIELD_COLUMNS_DEFAULTS = dict.fromkeys(RESULT_FIELD_COLUMNS)
+RESULT_FIELD_COLUMNS_DEFAULTS["Match Level"] = "No Match"
+# Anki columns read for matching, in AnkiRow field order
+ANKI_COLUMNS = ["Note ID", "Bulgarian 1", "Bulgarian 2", "Part of Speech"]
+AnkiRow = namedtuple("AnkiRow", ["note_id", "bulgarian_1", "bulgarian_2", "part_of_speech"])
+ANKI_SNAPSHOT_EXTENSIONS = {"feather": ".feather", "pickle": ".pkl"}
+
+# Conjugation span titles -> verb aspect, and the aspect columns filled from the aspect index
+ASPECTS = {"imperfective form": "imperfective", "perfective form": "perfective"}
+ASPECT_COLUMNS = ["Aspect", "Imperfective Present", "Perfective Present"]
+# Morphology columns filled from the inflection index, in Anki sheet order
+ADJECTIVE_FORM_COLUMNS = ["Adjective Masculine", "Adjective Feminine", "Adjective Neuter", "Adjective Plural"]
+NOUN_FORM_COLUMNS = [
+    "Noun Short Definite", "Noun Long Definite", "Noun Plural", "Noun Numeral Plural", "Noun Plural Definite"
+]
+INFLECTION_COLUMNS = ADJECTIVE_FORM_COLUMNS + NOUN_FORM_COLUMNS
+# Sense-numbered translation columns: the n-th rom (Roman numeral) and its first arabs (Arabic numerals)
+TRANSLATION_GRID_LAYOUT = [("I", 5), ("II", 3), ("III", 5), ("IV", 2), ("V", 1)]
+TRANSLATION_GRID_COLUMNS = [
+    f"PONS en {roman}.{arab}" for roman, arab_count in TRANSLATION_GRID_LAYOUT for arab in range(1, arab_count + 1)
+]
+
+BULGARIAN_2_SUFFIX = " (Bulgarian 2)"
+RESULT_COLUMNS = (
+    ["Note ID", "Bulgarian 1", "Part of Speech", "Bulgarian 2"]
+    + RESULT_FIELD_COLUMNS
+    + [f"{column}{BULGARIAN_2_SUFFIX}" for column in RESULT_FIELD_COLUMNS]
+    + ["PONS Status 1", "PONS Status 2"]
+    + TRANSLATION_GRID_COLUMNS
+    + ASPECT_COLUMNS
+    + INFLECTION_COLUMNS
+)
+# Result columns stored as integers by typed sinks (parquet, sqlite); all others are text
+RESULT_COLUMN_TYPES = {"Note ID": int, "Fuzzy Distance": int, f"Fuzzy Distance{BULGARIAN_2_SUFFIX}": int}
+
+# SpreadsheetML namespaces for the streamed Results sheet
+SPREADSHEETML_NAMESPACE = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+RELATIONSHIPS_NAMESPACE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+ILLEGAL_XML_CHARACTERS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# Zip local file header size and the general-purpose flag bit announcing a trailing data descriptor
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
 
-# Ensure the output directory exists
-os.makedirs(output_directory, exist_ok=True)
+# Span patterns used by the matcher, compiled once
+# Span classes of the partial-match levels, looked up in rom/arab headers before sources
+PARTIAL_MATCH_CLASSES = [
+    ("indirect_reference_OTHER", "3b"),
+    ("indirect_reference_RQ", "3c"),
+    ("full_collocation", "3d"),
+    ("reflection", "3e"),
+]
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+TILDE_PATTERN = re.compile(r'(<strong\b[^>]*\bclass="tilde"[^>]*>)(.*?)(</strong>)', re.DOTALL)
+# Result columns holding hints, rendered before output
+HINT_RESULT_COLUMNS = [f"Hint {number}" for number in range(1, HINT_COUNT + 1)]
+HINT_RESULT_COLUMNS += [f"{column}{BULGARIAN_2_SUFFIX}" for column in HINT_RESULT_COLUMNS]
+
+# Markup parsing of PONS fields
+MARKUP_TAG_PATTERN = re.compile(r'<(/?)([A-Za-z][\w-]*)([^>]*?)(/?)>')
+MARKUP_CLASS_PATTERN = re.compile(r'\bclass\s*=\s*["\']([^"\']*)["\']')
+MARKUP_TITLE_PATTERN = re.compile(r'\btitle\s*=\s*["\']([^"\']*)["\']')
+VOID_TAGS = frozenset(["br", "img", "hr", "wbr"])
+EMPTY_ATTRIBUTES = {}
+# Span open/close tags and whole acronym elements, for span-class-aware acronym expansion
+ACRONYM_TOKEN_PATTERN = re.compile(r'<span\b([^>]*)>|</span>|<acronym\b([^>]*)>(.*?)</acronym>', re.DOTALL)
+
+# Raw worksheet XML, for rewriting Anki cells in place
+ROW_START_PATTERN = re.compile(r'<row[\s>/]')
+ROW_NUMBER_PATTERN = re.compile(r'\br="(\d+)"')
+ROW_SPANS_PATTERN = re.compile(r'\sspans="[^"]*"')
+CELL_PATTERN = re.compile(r'<c\b([^>]*?\br="([A-Z]+)\d+"[^>]*?)(/>|>(.*?)</c>)', re.DOTALL)
+CELL_TYPE_PATTERN = re.compile(r'\bt="(\w+)"')
+CELL_STYLE_PATTERN = re.compile(r'\bs="(\d+)"')
+CELL_VALUE_PATTERN = re.compile(r'<v>(.*?)</v>', re.DOTALL)
+INLINE_TEXT_PATTERN = re.compile(r'<t(?:\s[^>]*)?>(.*?)</t>', re.DOTALL)
+# Example values in the schema profile are cut to this many characters
+SCHEMA_SAMPLE_LENGTH = 200
+# JSON type names reported by the schema profiler
+JSON_TYPE_NAMES = {
+    dict: "object", list: "array", str: "string", int: "integer", float: "number", bool: "boolean", type(None): "null"
+}
+# Classes of stored responses reported by the validate mode
+VALIDATION_CATEGORIES = [
+    "ok", "not_found_204", "http_error", "exception", "empty_hits",
+    "hits_without_roms", "rom_without_wordclass", "malformed_span"
+]
+# Span classes indexed by FacetIndex
+FACET_CLASSES = ["wordclass", "genus", "verbclass", "conjugation", "style", "region", "topic"]
+# One step of a path expression: [index], [*], .key or .*
+PATH_STEP_PATTERN = re.compile(r'\[(\*|\d+)\]|(?:^|\.)(\*|[^.\[\]]+)')
 
 # Strings to be cut off during re-search
 cutoff_strings = [
     " се", " [в]", " си", " [с]", " за", " в", " (се)", " (се) [с]", " (се) да"
 ]
 
-# Setup logging (reduce to INFO to shrink file)
-log_file = os.path.join(base_directory, f"debug_{datetime.now().strftime('%Y%m%dT%H%M%S')}.log")
-logging.basicConfig(
-    filename=log_file,
-    level=logging.INFO,  # set to INFO to keep log file smaller
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-logging.info("Script started")
-logging.info(f"Mode: {mode}")
-
-def extract_roms(data):
+def setup_run():
     """
-    Extract ROMS from JSON data.
+    Create the output directory and open the debug log of this run.
+    Only the main process calls this; the worker processes of profile_schema and validate_corpus
+    import the script under spawn and must not create a log file of their own.
     """
-    if not isinstance(data, dict):
-        logging.error(f"extract_roms called with non-dict data type: {type(data)}; data={str(data)[:200]}")
-        return []
-    hits = data.get("hits", [])
-    for hit in hits:
-        for rom in hit.get("roms", []):
-            yield rom
+    # Ensure the output directory exists
+    os.makedirs(output_directory, exist_ok=True)
 
-def extract_wordclass(rom):
-    """
-    Extract wordclass from headword_full.
-    """
-    headword_full = rom.get("headword_full", "")
-    match = re.search(r'<span class="wordclass">([^<]+)</span>', headword_full)
-    return match.group(1) if match else None
+    # Setup logging (reduce to INFO to shrink file)
+    log_file = os.path.join(base_directory, f"debug_{datetime.now().strftime('%Y%m%dT%H%M%S')}.log")
+    logging.basicConfig(
+        filename=log_file,
+        level=logging.INFO,  # set to INFO to keep log file smaller
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    logging.info("Script started")
+    logging.info(f"Mode: {mode}")
 
-def match_partial(bulgarian_1, data):
+def extract_roms(data):
     """
-    Match partial fields like indirect references, full_collocation, or reflection.
+    Extract ROMS from JSON data.
+    Accepts the PONS response as returned by the API (a list of language blocks)
+    as well as a single block with "hits".
     """
-    for rom in extract_roms(data):
-        header = rom.get("header", "")
-        source = rom.get("source", "")
-
-        partial_matches = [
-            (r'<span class="indirect_reference_OTHER">([^<]+)</span>', "3b"),
-            (r'<span class="indirect_reference_RQ">([^<]+)</span>', "3c"),
-            (r'<span class="full_collocation">([^<]+)</span>', "3d"),
-            (r'<span class="reflection">([^<]+)</span>', "3e"),
-        ]
-
-        for pattern, level in partial_matches:
-            match = re.search(pattern, header) or re.search(pattern, source)
-            if match and bulgarian_1 == match.group(1):
-                return level, match.group(1)
-    return "No Match", None
+    if isinstance(data, dict):
+        blocks = [data]
+    elif isinstance(data, list):
+        blocks = data
+    else:
+        logging.error(f"extract_roms called with unsupported data type: {type(data)}; data={str(data)[:200]}")
+        return
+    for block in blocks:
+        if not isinstance(block, dict):
+            continue
+        for hit in block.get("hits", []):
+            for rom in hit.get("roms", []):
+                yield rom
 
 def apply_cutoff_logic(bulgarian_1):
     """
@@ -96,62 +368,155 @@ def apply_cutoff_logic(bulgarian_1):
             return cutoff, revised_query
     return None, None
 
-def extract_hints(data):
+def fingerprint(value):
     """
-    Extract example hints or other supporting info from JSON data.
+    Stable SHA-1 fingerprint of a JSON-serializable value.
     """
-    hints = []
+    payload = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def row_fingerprint(anki_row):
+    """
+    Fingerprint of the Anki fields that drive matching for a row.
+    """
+    return fingerprint(list(anki_row))
+
+def entry_fingerprint(json_entry):
+    """
+    Fingerprint of a stored PONS response (query plus data).
+    """
+    return fingerprint([json_entry.get("query"), json_entry.get("data")])
+
+def read_reconcile_state():
+    """
+    Read the state file of the previous process run as is, or None if it is missing or unreadable.
+    """
+    if not os.path.exists(reconcile_state_path):
+        logging.info("No reconcile state found; all rows will be evaluated.")
+        return None
+    try:
+        with open(reconcile_state_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except Exception as e:
+        logging.warning(f"Could not read reconcile state from {reconcile_state_path}: {e}")
+        return None
+
+def load_reconcile_state(state=None):
+    """
+    Load the fingerprints and results saved by the previous process run.
+    Returns None if there is no usable state (missing, unreadable or from another version).
+    An already read state can be passed in to be validated.
+    """
+    state = state if state is not None else read_reconcile_state()
+    if state is None:
+        return None
+    if state.get("version") != reconcile_state_version:
+        logging.info("Reconcile state is from a different version; all rows will be evaluated.")
+        return None
+    if state.get("settings") != reconcile_settings_fingerprint():
+        logging.info("Matching settings changed since the last run; all rows will be evaluated.")
+        return None
+    return state
+
+def reconcile_settings_fingerprint():
+    """
+    Fingerprint of the configuration that shapes results, so changing it invalidates the state.
+    """
+    return fingerprint([
+        cutoff_strings, fuzzy_max_distance, match_strategy_order, expand_hint_acronyms, strip_hint_html,
+        hint_tilde_marker
+    ])
+
+def save_reconcile_state(state):
+    """
+    Persist fingerprints and results for the next incremental run.
+    """
+    write_json_atomic(reconcile_state_path, state)
+    logging.info(f"Saved reconcile state for {len(state['rows'])} rows to {reconcile_state_path}")
+
+def row_needs_rematch(anki_row, previous, entry_fingerprints, dirty_keys, corpus_changed):
+    """
+    Decide whether a row whose own fingerprint is unchanged must still be re-evaluated.
+    That is the case, for either Bulgarian field, when its matched entry changed or disappeared,
+    when a new or changed entry carries the field's (cut-off) key as its query or a headword,
+    or when an unmatched or fuzzy-matched field meets a changed corpus.
+    """
+    result = previous["result"]
+    field_levels = [result.get("Match Level"), result.get(f"Match Level{BULGARIAN_2_SUFFIX}")]
+    terms = [anki_row.bulgarian_1, anki_row.bulgarian_2]
+    for term, level, matched_query, entry_fp in zip(terms, field_levels, previous["entries"], previous["entry_fps"]):
+        if not term:
+            continue
+        # Fuzzy matches depend on every term in the corpus, like fields that found no match at all
+        if matched_query is None or level == "5":
+            if corpus_changed:
+                return True
+            continue
+        if entry_fingerprints.get(matched_query) != entry_fp:
+            return True
+        if dirty_keys:
+            _, revised_query = apply_cutoff_logic(term)
+            if normalize_key(term) in dirty_keys or normalize_key(revised_query) in dirty_keys:
+                return True
+    return False
+
+def fetch_entry(idx, query_term):
+    """
+    Fetch one query from the PONS API as a concatenated.json entry; failures are stored as an error entry.
+    """
+    logging.info(f"[{idx}] Fetching data for query: {query_term}")
+    url = f"https://api.pons.com/v1/dictionary?q={query_term}&l=bgen"
+    headers = {
+        "X-Secret": "XXX"
+    }
     try:
-        for rom in extract_roms(data):
-            examples = rom.get("examples", [])
-            for example in examples:
-                hints.append(example)
+        response = requests.get(url, headers=headers)
+        if response.status_code == 200:
+            logging.info(f"Successful API response for query: {query_term}")
+            return {
+                "query": query_term,
+                "data": response.json()
+            }
+        logging.warning(f"Failed API response for query: {query_term}, Status Code: {response.status_code}")
+        return {
+            "query": query_term,
+            "data": {
+                "error": f"Received status code {response.status_code}",
+                "response_text": response.text
+            }
+        }
     except Exception as e:
-        logging.error(f"Exception in extract_hints: {e}", exc_info=True)
-    return hints
+        logging.error(f"Exception during request for {query_term}: {e}", exc_info=True)
+        return {
+            "query": query_term,
+            "data": {
+                "error": f"Exception: {e}"
+            }
+        }
 
 def fetch_and_concatenate():
     """
     Fetches data from the PONS API for each query term and concatenates all results into a single JSON file.
+    With fetch_refetch_list, only the queries in refetch_list_path (written by the validate mode) are
+    fetched, and their entries replace the stored ones in concatenated.json.
     """
     logging.info("Starting fetch_and_concatenate process.")
-    concatenated_data = []
+    query_file_path = refetch_list_path if fetch_refetch_list else input_file_path
 
     try:
-        with open(input_file_path, 'r', encoding='utf-8') as file:
-            for idx, line in enumerate(file):
-                query_term = line.strip()
-                if query_term:
-                    logging.info(f"[{idx}] Fetching data for query: {query_term}")
-                    url = f"https://api.pons.com/v1/dictionary?q={query_term}&l=bgen"
-                    headers = {
-                        "X-Secret": "XXX"
-                    }
-                    try:
-                        response = requests.get(url, headers=headers)
-                        if response.status_code == 200:
-                            logging.info(f"Successful API response for query: {query_term}")
-                            concatenated_data.append({
-                                "query": query_term,
-                                "data": response.json()
-                            })
-                        else:
-                            logging.warning(f"Failed API response for query: {query_term}, Status Code: {response.status_code}")
-                            concatenated_data.append({
-                                "query": query_term,
-                                "data": {
-                                    "error": f"Received status code {response.status_code}",
-                                    "response_text": response.text
-                                }
-                            })
-                    except Exception as e:
-                        logging.error(f"Exception during request for {query_term}: {e}", exc_info=True)
-                        concatenated_data.append({
-                            "query": query_term,
-                            "data": {
-                                "error": f"Exception: {e}"
-                            }
-                        })
+        with open(query_file_path, 'r', encoding='utf-8') as file:
+            concatenated_data = [
+                fetch_entry(idx, line.strip()) for idx, line in enumerate(file) if line.strip()
+            ]
+        if fetch_refetch_list and os.path.exists(concatenated_file_path):
+            fetched = {json_entry["query"]: json_entry for json_entry in concatenated_data}
+            with open(concatenated_file_path, 'r', encoding='utf-8') as file:
+                stored_data = json.load(file)
+            stored_queries = {json_entry["query"] for json_entry in stored_data}
+            concatenated_data = [fetched.get(json_entry["query"], json_entry) for json_entry in stored_data] + [
+                json_entry for query, json_entry in fetched.items() if query not in stored_queries
+            ]
+            logging.info(f"Refetched {len(fetched)} queries from {refetch_list_path} into {len(concatenated_data)} stored entries.")
         # Save the concatenated data to a single JSON file
         with open(concatenated_file_path, 'w', encoding='utf-8') as output_file:
             json.dump(concatenated_data, output_file, ensure_ascii=False, indent=4)
@@ -159,239 +524,3446 @@ def fetch_and_concatenate():
     except Exception as e:
         logging.error(f"Exception in fetch_and_concatenate: {e}", exc_info=True)
 
-def write_results_to_xlsm(results, xlsm_path, sheet_name="Results"):
+class ResultsSheetWriter:
     """
-    Write the results to a 'Results' worksheet in the existing XLSM file, preserving macros,
-    and format the sheet as a table with auto-fit columns.
+    Streams result rows into a SpreadsheetML worksheet part without keeping them in memory.
+    Rows are serialized to a temporary file as they arrive while column widths are tracked;
+    write_sheet() and table_xml() then emit the finished worksheet and its table definition.
     """
-    logging.info(f"Writing {len(results)} results to '{sheet_name}' in {xlsm_path}")
-    df = pd.DataFrame(results)
-    wb = load_workbook(xlsm_path, keep_vba=True)
-    # Remove old Results sheet if it exists
-    if sheet_name in wb.sheetnames:
-        std = wb[sheet_name]
-        wb.remove(std)
-    # Add DataFrame as new worksheet
-    ws = wb.create_sheet(title=sheet_name)
-    for r in dataframe_to_rows(df, index=False, header=True):
-        ws.append(r)
-
-    # Auto-fit column widths (based on cell content length)
-    for column in ws.columns:
-        max_length = max(len(str(cell.value)) if cell.value is not None else 0 for cell in column)
-        column_letter = column[0].column_letter
-        ws.column_dimensions[column_letter].width = max_length + 2  # Add padding for readability
-
-    # Create a table in the worksheet
-    last_col_letter = ws.cell(row=1, column=ws.max_column).column_letter
-    table_range = f"A1:{last_col_letter}{ws.max_row}"  # Covers all rows including headers
-    table = Table(displayName="Results", ref=table_range)
-
-    # Apply a table style (medium, row stripes, no column stripes)
-    style = TableStyleInfo(
-        name="TableStyleMedium2",
-        showFirstColumn=False,
-        showLastColumn=False,
-        showRowStripes=True,
-        showColumnStripes=False
-    )
-    table.tableStyleInfo = style
-    ws.add_table(table)
 
-    wb.save(xlsm_path)
-    logging.info(f"Wrote {len(results)} results to {xlsm_path} in sheet '{sheet_name}' (as table)")
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.letters = [get_column_letter(position) for position in range(1, len(self.columns) + 1)]
+        self.widths = [0] * len(self.columns)
+        self.rows_file = tempfile.TemporaryFile()
+        self.row_count = 0
+        self.append(self.columns)
 
-def process_and_reconcile():
+    def append(self, values):
+        """
+        Serialize one row of values (in column order) and update the column widths.
+        """
+        self.row_count += 1
+        cells = []
+        for position, value in enumerate(values):
+            if value is None:
+                continue
+            text = value if isinstance(value, str) else str(value)
+            self.widths[position] = max(self.widths[position], len(text))
+            ref = f"{self.letters[position]}{self.row_count}"
+            if isinstance(value, bool):
+                cells.append(f'<c r="{ref}" t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, (int, float)):
+                cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+            else:
+                text = xml_escape(ILLEGAL_XML_CHARACTERS.sub('', text))
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+        row = f'<row r="{self.row_count}">{"".join(cells)}</row>'
+        self.rows_file.write(row.encode("utf-8"))
+
+    @property
+    def ref(self):
+        # A table needs at least one body row, even an empty one
+        return f"A1:{self.letters[-1]}{max(self.row_count, 2)}"
+
+    def write_sheet(self, out, table_rel_id):
+        """
+        Write the complete worksheet part to the binary file object `out`.
+        """
+        cols = "".join(
+            f'<col min="{position}" max="{position}" width="{width + 2}" customWidth="1"/>'
+            for position, width in enumerate(self.widths, 1)
+        )
+        out.write((
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<worksheet xmlns="{SPREADSHEETML_NAMESPACE}" xmlns:r="{RELATIONSHIPS_NAMESPACE}">'
+            f'<dimension ref="{self.ref}"/><sheetFormatPr defaultRowHeight="15"/>'
+            f'<cols>{cols}</cols><sheetData>'
+        ).encode("utf-8"))
+        self.rows_file.seek(0)
+        shutil.copyfileobj(self.rows_file, out)
+        out.write((
+            '</sheetData>'
+            f'<tableParts count="1"><tablePart r:id="{table_rel_id}"/></tableParts>'
+            '</worksheet>'
+        ).encode("utf-8"))
+
+    def table_xml(self, table_id, table_name):
+        """
+        Table definition covering every streamed row, styled like the previous openpyxl table.
+        """
+        table_columns = "".join(
+            f'<tableColumn id="{position}" name={xml_quoteattr(str(column))}/>'
+            for position, column in enumerate(self.columns, 1)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<table xmlns="{SPREADSHEETML_NAMESPACE}" id="{table_id}" name={xml_quoteattr(table_name)} '
+            f'displayName={xml_quoteattr(table_name)} ref="{self.ref}" headerRowCount="1">'
+            f'<autoFilter ref="{self.ref}"/>'
+            f'<tableColumns count="{len(self.columns)}">{table_columns}</tableColumns>'
+            '<tableStyleInfo name="TableStyleMedium2" showFirstColumn="0" showLastColumn="0" '
+            'showRowStripes="1" showColumnStripes="0"/>'
+            '</table>'
+        ).encode("utf-8")
+
+    def close(self):
+        self.rows_file.close()
+
+def resolve_part(base_part, target):
     """
-    Processes entries from concatenated.json, reconciles them with Flashcards.xlsm,
-    and saves the combined results into the 'Results' worksheet of Flashcards.xlsm.
+    Resolve a relationship target relative to the part that owns the relationship.
     """
-    logging.info("Starting process_and_reconcile function.")
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_part), target))
 
-    if not os.path.exists(concatenated_file_path):
-        logging.error(f"Concatenated JSON file not found at {concatenated_file_path}.")
-        return
+def rels_part(part):
+    """
+    Path of the relationships part belonging to `part`.
+    """
+    return posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels")
 
-    if not os.path.exists(flashcards_xlsm_path):
-        logging.error(f"Flashcards.xlsm file not found at {flashcards_xlsm_path}.")
-        return
+def find_sheet_part(package, sheet_name):
+    """
+    Locate the worksheet part of `sheet_name` in an open workbook package (zipfile.ZipFile).
+    Returns the part path, or None if the workbook has no such sheet.
+    """
+    workbook = ElementTree.fromstring(package.read("xl/workbook.xml"))
+    relationships = ElementTree.fromstring(package.read("xl/_rels/workbook.xml.rels"))
+    targets = {rel.get("Id"): rel.get("Target") for rel in relationships}
+    for sheet in workbook.iter(f"{{{SPREADSHEETML_NAMESPACE}}}sheet"):
+        if sheet.get("name") == sheet_name:
+            return resolve_part("xl/workbook.xml", targets[sheet.get(f"{{{RELATIONSHIPS_NAMESPACE}}}id")])
+    return None
+
+def find_table_part(package, sheet_part):
+    """
+    Return (relationship id, table part path) of the first table attached to a worksheet part.
+    """
+    relationships = ElementTree.fromstring(package.read(rels_part(sheet_part)))
+    for rel in relationships:
+        if rel.get("Type", "").endswith("/table"):
+            return rel.get("Id"), resolve_part(sheet_part, rel.get("Target"))
+    return None, None
+
+def read_shared_strings(package):
+    """
+    Load the shared string table of a workbook package as a list (rich text runs are joined).
+    """
+    if "xl/sharedStrings.xml" not in package.namelist():
+        return []
+    item_tag = f"{{{SPREADSHEETML_NAMESPACE}}}si"
+    text_tag = f"{{{SPREADSHEETML_NAMESPACE}}}t"
+    run_tag = f"{{{SPREADSHEETML_NAMESPACE}}}r"
+    strings = []
+    with package.open("xl/sharedStrings.xml") as stream:
+        for _, element in ElementTree.iterparse(stream):
+            if element.tag == item_tag:
+                # Plain <t> or <r><t> runs; phonetic <rPh> runs are not part of the value
+                texts = [child.text or "" for child in element if child.tag == text_tag]
+                texts += [run.findtext(text_tag, "") for run in element if run.tag == run_tag]
+                strings.append("".join(texts))
+                element.clear()
+    return strings
+
+def cell_value(cell, shared_strings):
+    """
+    Python value of a worksheet <c> element: shared and inline strings, booleans, and
+    numbers (integral numbers as int, so Note IDs come back as they were typed).
+    """
+    cell_type = cell.get("t")
+    if cell_type == "inlineStr":
+        return "".join(text.text or "" for text in cell.iter(f"{{{SPREADSHEETML_NAMESPACE}}}t"))
+    value = cell.findtext(f"{{{SPREADSHEETML_NAMESPACE}}}v")
+    if value is None:
+        return None
+    if cell_type == "s":
+        return shared_strings[int(value)]
+    if cell_type == "b":
+        return value == "1"
+    if cell_type in ("str", "e"):
+        return value
+    number = float(value)
+    return int(number) if number.is_integer() and "E" not in value.upper() else number
+
+def column_letters(cell_ref):
+    """
+    Column part of a cell reference ("AB12" -> "AB").
+    """
+    return cell_ref.rstrip("0123456789")
+
+def iter_anki_rows_xml(xlsm_path, sheet_name="Anki"):
+    """
+    Anki rows of an .xlsx/.xlsm workbook, parsing the worksheet XML directly.
+    The header row is read once to find the ANKI_COLUMNS; only those cells are converted
+    on every following row, the other columns are skipped without being materialized.
+    """
+    row_tag = f"{{{SPREADSHEETML_NAMESPACE}}}row"
+    cell_tag = f"{{{SPREADSHEETML_NAMESPACE}}}c"
+    with zipfile.ZipFile(xlsm_path) as package:
+        sheet_part = find_sheet_part(package, sheet_name)
+        if sheet_part is None:
+            raise KeyError(f"Sheet '{sheet_name}' not found in {xlsm_path}")
+        shared_strings = read_shared_strings(package)
+        projection = None
+        with package.open(sheet_part) as stream:
+            for _, element in ElementTree.iterparse(stream):
+                if element.tag != row_tag:
+                    continue
+                if projection is None:
+                    headers = {
+                        cell_value(cell, shared_strings): column_letters(cell.get("r"))
+                        for cell in element.iter(cell_tag)
+                    }
+                    missing = [column for column in ANKI_COLUMNS if column not in headers]
+                    if missing:
+                        raise KeyError(f"Columns {missing} not found in sheet '{sheet_name}'")
+                    # Column letter -> position in AnkiRow
+                    projection = {headers[column]: position for position, column in enumerate(ANKI_COLUMNS)}
+                else:
+                    values = [None] * len(ANKI_COLUMNS)
+                    for cell in element.iter(cell_tag):
+                        position = projection.get(column_letters(cell.get("r")))
+                        if position is not None:
+                            values[position] = cell_value(cell, shared_strings)
+                    yield AnkiRow._make(values)
+                element.clear()
+
+def project_anki_rows(rows, sheet_name):
+    """
+    Turn an iterator of full rows (header first) into AnkiRow tuples of the ANKI_COLUMNS.
+    Used by the backends that hand out whole rows; integral floats become int.
+    """
+    headers = list(next(rows, []))
+    missing = [column for column in ANKI_COLUMNS if column not in headers]
+    if missing:
+        raise KeyError(f"Columns {missing} not found in sheet '{sheet_name}'")
+    indexes = [headers.index(column) for column in ANKI_COLUMNS]
+    for row in rows:
+        values = []
+        for index in indexes:
+            value = row[index] if index < len(row) else None
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            values.append(value)
+        yield AnkiRow._make(values)
 
+def iter_anki_rows_openpyxl(workbook_path, sheet_name="Anki"):
+    """
+    Anki rows through openpyxl's read-only mode.
+    """
+    wb = load_workbook(workbook_path, read_only=True, keep_vba=True)
     try:
-        logging.info("Loading concatenated.json file.")
-        with open(concatenated_file_path, 'r', encoding='utf-8') as file:
-            concatenated_data = json.load(file)
-        logging.info(f"Loaded {len(concatenated_data)} entries from concatenated.json.")
+        if sheet_name not in wb.sheetnames:
+            raise KeyError(f"Sheet '{sheet_name}' not found in {workbook_path}")
+        yield from project_anki_rows(wb[sheet_name].iter_rows(values_only=True), sheet_name)
+    finally:
+        wb.close()
 
-        # Use pandas to read the Anki sheet from XLSM
-        anki_data = []
+def iter_anki_rows_xlsb(workbook_path, sheet_name="Anki"):
+    """
+    Anki rows from a binary .xlsb workbook through pyxlsb.
+    """
+    if open_xlsb_workbook is None:
+        raise ImportError("pyxlsb is required to read .xlsb workbooks")
+    with open_xlsb_workbook(workbook_path) as workbook:
+        with workbook.get_sheet(sheet_name) as sheet:
+            rows = ([cell.v for cell in row] for row in sheet.rows())
+            yield from project_anki_rows(rows, sheet_name)
+
+def iter_anki_rows_calamine(workbook_path, sheet_name="Anki"):
+    """
+    Anki rows through python-calamine (Rust), which reads .xlsx, .xlsm and .xlsb.
+    """
+    if CalamineWorkbook is None:
+        raise ImportError("python-calamine is not installed")
+    sheet = CalamineWorkbook.from_path(workbook_path).get_sheet_by_name(sheet_name)
+    # Calamine reports empty cells as "", the other readers as None
+    rows = ([None if value == "" else value for value in row] for row in sheet.iter_rows())
+    yield from project_anki_rows(rows, sheet_name)
+
+ANKI_READERS = {
+    "xml": iter_anki_rows_xml,
+    "openpyxl": iter_anki_rows_openpyxl,
+    "pyxlsb": iter_anki_rows_xlsb,
+    "calamine": iter_anki_rows_calamine,
+}
+
+def available_anki_readers(workbook_path):
+    """
+    Reader backends that can open `workbook_path`, fastest first.
+    """
+    if os.path.splitext(workbook_path)[1].lower() == ".xlsb":
+        candidates = [("calamine", CalamineWorkbook), ("pyxlsb", open_xlsb_workbook)]
+    else:
+        candidates = [("calamine", CalamineWorkbook), ("xml", True), ("openpyxl", True)]
+    return [name for name, module in candidates if module is not None]
+
+def iter_anki_rows(workbook_path, sheet_name="Anki", backend=None):
+    """
+    Stream the Anki sheet as AnkiRow tuples with the configured anki_reader_backend;
+    "auto" picks the fastest installed backend for the workbook's extension.
+    """
+    backend = backend or anki_reader_backend
+    if backend == "auto":
+        readers = available_anki_readers(workbook_path)
+        if not readers:
+            raise ImportError(f"No installed reader can open {workbook_path} (install pyxlsb or python-calamine)")
+        backend = readers[0]
+    if backend not in ANKI_READERS:
+        raise ValueError(f"Unknown Anki reader backend: {backend}")
+    logging.info(f"Reading sheet '{sheet_name}' from {workbook_path} with the {backend} reader.")
+    return ANKI_READERS[backend](workbook_path, sheet_name)
+
+def benchmark_anki_readers():
+    """
+    Time every reader backend that can open the Anki workbook and check they agree.
+    """
+    logging.info("Starting benchmark_anki_readers function.")
+    if not os.path.exists(anki_workbook_path):
+        logging.error(f"Anki workbook not found at {anki_workbook_path}.")
+        return
+    reference = None
+    for backend in available_anki_readers(anki_workbook_path):
         try:
-            wb = load_workbook(flashcards_xlsm_path, read_only=True, keep_vba=True)
-            if "Anki" not in wb.sheetnames:
-                logging.error("Sheet 'Anki' not found in Flashcards.xlsm.")
-                return
-            ws = wb["Anki"]
-            rows = list(ws.iter_rows(values_only=True))
-            headers = rows[0]
-            for i, row in enumerate(rows[1:]):
-                row_data = dict(zip(headers, row))
-                # Only keep relevant fields
-                anki_data.append({
-                    "Bulgarian 1": row_data.get("Bulgarian 1"),
-                    "Bulgarian 2": row_data.get("Bulgarian 2"),
-                    "Part of Speech": row_data.get("Part of Speech"),
-                    "Note ID": row_data.get("Note ID")
-                })
-            logging.info(f"Collected {len(anki_data)} rows from Anki worksheet.")
+            timings = []
+            for _ in range(benchmark_repeats):
+                start = time.perf_counter()
+                rows = list(iter_anki_rows(anki_workbook_path, sheet_name="Anki", backend=backend))
+                timings.append(time.perf_counter() - start)
+            if reference is None:
+                reference, agreement = rows, "reference"
+            else:
+                agreement = "same rows" if rows == reference else "ROWS DIFFER"
+            logging.info(f"Reader {backend:<9} {len(rows):>7} rows  best {min(timings):.3f}s  "
+                         f"mean {sum(timings) / len(timings):.3f}s  ({agreement})")
+            print(f"{backend:<9} best {min(timings):.3f}s over {benchmark_repeats} runs, {len(rows)} rows ({agreement})")
         except Exception as e:
-            logging.error(f"Error loading Anki sheet from Flashcards.xlsm: {e}", exc_info=True)
-            return
+            logging.error(f"Reader {backend} failed: {e}", exc_info=True)
 
-        results = []
+def write_json_atomic(path, value, indent=None):
+    """
+    Write `value` as JSON next to `path` and move it into place.
+    """
+    temp_path = path + ".tmp"
+    # json.dumps runs the C encoder; json.dump streams through the much slower Python one
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(json.dumps(value, ensure_ascii=False, indent=indent))
+    os.replace(temp_path, path)
 
-        logging.info("Starting matching logic.")
-        for idx, anki_row in enumerate(anki_data):
-            bulgarian_1 = anki_row["Bulgarian 1"]
-            part_of_speech = anki_row["Part of Speech"]
-            note_id = anki_row["Note ID"]
-            bulgarian_2 = anki_row["Bulgarian 2"]
-
-            match_level = "No Match"
-            matched_value = None
-            cutoff_applied = None
-            hint_1 = None
-            hint_2 = None
-            pons_status_1 = "Unmatched"
-            pons_status_2 = ""
-
-            found_match = False
-
-            for json_entry in concatenated_data:
-                query = json_entry["query"]
-                data = json_entry.get("data", {})
-
-                # Level 1: Exact match with matching wordclass
-                if bulgarian_1 == query:
-                    for rom in extract_roms(data):
-                        wordclass = extract_wordclass(rom)
-                        if wordclass == part_of_speech:
-                            match_level = "1"
-                            matched_value = query
-                            hints = extract_hints(data)
-                            hint_1, hint_2 = hints if len(hints) > 1 else (hints[0], None) if hints else (None, None)
-                            pons_status_1 = "Exact Match"
-                            pons_status_2 = "Wordclass Match"
-                            found_match = True
-                            break
-                    if found_match:
-                        break
-
-            if not found_match:
-                for json_entry in concatenated_data:
-                    query = json_entry["query"]
-                    data = json_entry.get("data", {})
-                    if bulgarian_1 == query:
-                        match_level = "2"
-                        matched_value = query
-                        hints = extract_hints(data)
-                        hint_1, hint_2 = hints if len(hints) > 1 else (hints[0], None) if hints else (None, None)
-                        pons_status_1 = "Exact Match"
-                        pons_status_2 = "No Wordclass Match"
-                        found_match = True
-                        break
-
-            if not found_match:
-                for json_entry in concatenated_data:
-                    query = json_entry["query"]
-                    data = json_entry.get("data", {})
-                    level, match_val = match_partial(bulgarian_1, data)
-                    if level != "No Match":
-                        match_level = level
-                        matched_value = match_val
-                        hints = extract_hints(data)
-                        hint_1, hint_2 = hints if len(hints) > 1 else (hints[0], None) if hints else (None, None)
-                        pons_status_1 = "Partial Match"
-                        pons_status_2 = f"Level {level}"
-                        found_match = True
-                        break
-
-            if not found_match:
-                cutoff, revised_query = apply_cutoff_logic(bulgarian_1)
-                if cutoff and revised_query:
-                    for json_entry in concatenated_data:
-                        query = json_entry["query"]
-                        data = json_entry.get("data", {})
-                        # Try Level 1 again with revised query
-                        if revised_query == query:
-                            for rom in extract_roms(data):
-                                wordclass = extract_wordclass(rom)
-                                if wordclass == part_of_speech:
-                                    match_level = "4"
-                                    matched_value = revised_query
-                                    cutoff_applied = cutoff
-                                    hints = extract_hints(data)
-                                    hint_1, hint_2 = hints if len(hints) > 1 else (hints[0], None) if hints else (None, None)
-                                    pons_status_1 = "Cutoff Match"
-                                    pons_status_2 = f"Wordclass Match (cutoff: {cutoff})"
-                                    found_match = True
-                                    break
-                            if found_match:
-                                break
-                    if not found_match:
-                        for json_entry in concatenated_data:
-                            query = json_entry["query"]
-                            data = json_entry.get("data", {})
-                            if revised_query == query:
-                                match_level = "4"
-                                matched_value = revised_query
-                                cutoff_applied = cutoff
-                                hints = extract_hints(data)
-                                hint_1, hint_2 = hints if len(hints) > 1 else (hints[0], None) if hints else (None, None)
-                                pons_status_1 = "Cutoff Match"
-                                pons_status_2 = f"No Wordclass Match (cutoff: {cutoff})"
-                                found_match = True
-                                break
-
-            # PONS Status 2 should be blank if Bulgarian 2 is blank or None
-            if not bulgarian_2:
-                pons_status_2 = ""
-
-            results.append({
-                "Note ID": note_id,
-                "Bulgarian 1": bulgarian_1,
-                "Part of Speech": part_of_speech,
-                "Bulgarian 2": bulgarian_2,
-                "Match Level": match_level,
-                "Matched Value": matched_value,
-                "Cutoff Applied": cutoff_applied,
-                "Hint 1": hint_1,
-                "Hint 2": hint_2,
-                "PONS Status 1": pons_status_1,
-                "PONS Status 2": pons_status_2
-            })
-
-        # Save results to XLSM Results worksheet
+def file_sha1(path):
+    """
+    SHA-1 of a file's bytes, read in chunks.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def package_part_crcs(path):
+    """
+    {part: CRC-32} of a workbook package, taken from its zip directory (nothing is decompressed);
+    None if the file is no zip package.
+    """
+    try:
+        with zipfile.ZipFile(path) as package:
+            return {info.filename: info.CRC for info in package.infolist()}
+    except zipfile.BadZipFile:
+        return None
+
+def anki_sheet_crcs(workbook_path, sheet_name):
+    """
+    CRC-32 of the parts the Anki rows are read from (the worksheet and the shared strings),
+    or None if the workbook is no xlsx/xlsm package with such a sheet.
+    """
+    try:
+        with zipfile.ZipFile(workbook_path) as package:
+            sheet_part = find_sheet_part(package, sheet_name)
+            if sheet_part is None:
+                return None
+            crcs = {info.filename: info.CRC for info in package.infolist()}
+    except (zipfile.BadZipFile, KeyError):
+        return None
+    return {part: crcs[part] for part in (sheet_part, "xl/sharedStrings.xml") if part in crcs}
+
+def anki_snapshot_key(workbook_path, sheet_name):
+    """
+    Identity of the Anki table a snapshot was taken from; the content hash and the sheet CRCs
+    (see anki_sheet_crcs) are filled in separately.
+    """
+    stat = os.stat(workbook_path)
+    return {
+        "version": anki_snapshot_version,
+        "workbook": os.path.abspath(workbook_path),
+        "sheet": sheet_name,
+        "columns": ANKI_COLUMNS,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+
+def load_anki_snapshot(workbook_path, sheet_name):
+    """
+    Return the cached Anki rows if the snapshot matches the workbook, else None.
+    Size and mtime are compared first; if only the mtime moved, the content hash decides
+    (and the snapshot key is refreshed). The workbook itself is never opened as a spreadsheet.
+    """
+    meta_path = anki_snapshot_path + ".json"
+    if not os.path.exists(meta_path):
+        logging.info("No Anki snapshot found; the workbook will be read.")
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        key = anki_snapshot_key(workbook_path, sheet_name)
+        stored_key = dict(meta["key"])
+        stored_sha1 = stored_key.pop("sha1")
+        stored_parts = stored_key.pop("parts", None)
+        if stored_key != key:
+            if {**stored_key, "mtime": key["mtime"]} != key or file_sha1(workbook_path) != stored_sha1:
+                logging.info("Anki workbook changed since the last snapshot; the workbook will be read.")
+                return None
+            meta["key"] = {**key, "sha1": stored_sha1, "parts": stored_parts}
+            write_json_atomic(meta_path, meta)
+        data_path = anki_snapshot_path + ANKI_SNAPSHOT_EXTENSIONS[meta["format"]]
+        if meta["format"] == "feather":
+            columns = pyarrow_feather.read_table(data_path).to_pydict()
+        else:
+            with open(data_path, 'rb') as file:
+                columns = pickle.load(file)
+    except Exception as e:
+        logging.warning(f"Could not use the Anki snapshot at {anki_snapshot_path}: {e}")
+        return None
+    rows = [AnkiRow._make(values) for values in zip(*(columns[field] for field in AnkiRow._fields))]
+    logging.info(f"Loaded {len(rows)} Anki rows from the {meta['format']} snapshot.")
+    return rows
+
+def save_anki_snapshot(rows, key):
+    """
+    Store the Anki rows column by column: Feather when pyarrow is installed (and the columns
+    have consistent types), a pickled dict of lists otherwise.
+    """
+    columns = {field: [getattr(row, field) for row in rows] for field in AnkiRow._fields}
+    snapshot_format = "pickle"
+    if pyarrow is not None:
         try:
-            write_results_to_xlsm(results, flashcards_xlsm_path, sheet_name="Results")
-        except Exception as e:
-            logging.error(f"Exception saving results to Excel: {e}", exc_info=True)
+            data_path = anki_snapshot_path + ANKI_SNAPSHOT_EXTENSIONS["feather"]
+            pyarrow_feather.write_feather(pyarrow.table(columns), data_path + ".tmp")
+            os.replace(data_path + ".tmp", data_path)
+            snapshot_format = "feather"
+        except (pyarrow.ArrowException, TypeError, ValueError) as e:
+            logging.info(f"Anki columns do not fit a Feather table ({e}); using pickle.")
+    if snapshot_format == "pickle":
+        data_path = anki_snapshot_path + ANKI_SNAPSHOT_EXTENSIONS["pickle"]
+        with open(data_path + ".tmp", 'wb') as file:
+            pickle.dump(columns, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(data_path + ".tmp", data_path)
+    write_json_atomic(anki_snapshot_path + ".json", {"format": snapshot_format, "key": key})
+    logging.info(f"Saved {len(rows)} Anki rows to the {snapshot_format} snapshot.")
 
-        # Log summary statistics
-        logging.info(f"Processing complete. Total rows: {len(anki_data)}. Results saved to Results worksheet in Flashcards.xlsm.")
-        match_levels = Counter(result['Match Level'] for result in results)
-        for level, count in match_levels.items():
-            logging.info(f"Rows matched at level {level}: {count}")
+def refresh_anki_snapshot_key(workbook_path, source_crcs, sheet_name="Anki"):
+    """
+    Re-key an existing snapshot after this script rewrote the workbook, so writing results (and
+    write-back, which leaves the matching columns alone) does not invalidate it for the next run.
+    `source_crcs` are the part CRCs of the workbook as it was rewritten (see package_part_crcs);
+    unless its Anki parts are still those the snapshot was taken from, the Anki sheet was edited
+    during the run and the snapshot is invalidated instead.
+    """
+    meta_path = anki_snapshot_path + ".json"
+    if not anki_snapshot_enabled or not os.path.exists(meta_path):
+        return
+    with open(meta_path, 'r', encoding='utf-8') as file:
+        meta = json.load(file)
+    stored_parts = meta["key"].get("parts")
+    if not stored_parts or source_crcs is None or any(
+            source_crcs.get(part) != crc for part, crc in stored_parts.items()):
+        os.remove(meta_path)
+        logging.info("Anki sheet changed since it was read; the Anki snapshot was invalidated.")
+        return
+    meta["key"] = {
+        **anki_snapshot_key(workbook_path, sheet_name),
+        "sha1": file_sha1(workbook_path),
+        "parts": anki_sheet_crcs(workbook_path, sheet_name),
+    }
+    write_json_atomic(meta_path, meta)
 
+def load_anki_rows(workbook_path, sheet_name="Anki"):
+    """
+    The projected Anki table, from the snapshot when the workbook is unchanged and from
+    the workbook (through iter_anki_rows) otherwise.
+    """
+    if not anki_snapshot_enabled:
+        return list(iter_anki_rows(workbook_path, sheet_name=sheet_name))
+    rows = load_anki_snapshot(workbook_path, sheet_name)
+    if rows is not None:
+        return rows
+    # Key and hash are taken before reading, so a workbook saved mid-read is not cached as current
+    key = {
+        **anki_snapshot_key(workbook_path, sheet_name),
+        "sha1": file_sha1(workbook_path),
+        "parts": anki_sheet_crcs(workbook_path, sheet_name),
+    }
+    rows = list(iter_anki_rows(workbook_path, sheet_name=sheet_name))
+    try:
+        save_anki_snapshot(rows, key)
     except Exception as e:
-        logging.error(f"An error occurred in process_and_reconcile: {e}", exc_info=True)
+        logging.error(f"Exception saving Anki snapshot: {e}", exc_info=True)
+    return rows
 
-# Main workflow
-if mode == "fetch":
-    logging.info("Main: Running fetch_and_concatenate()")
-    fetch_and_concatenate()
-elif mode == "process":
-    logging.info("Main: Running process_and_reconcile()")
-    process_and_reconcile()
-else:
-    logging.error(f"Unknown mode: {mode}")
-    print(f"Unknown mode: {mode}")
-    print("Available modes: fetch, process")
+def raw_cell_value(attributes, body, shared_strings):
+    """
+    Python value of a cell given the raw text of its attributes and body (see CELL_PATTERN).
+    """
+    if body is None:
+        return None
+    cell_type = CELL_TYPE_PATTERN.search(attributes)
+    cell_type = cell_type.group(1) if cell_type else None
+    if cell_type == "inlineStr":
+        return html.unescape("".join(INLINE_TEXT_PATTERN.findall(body)))
+    value = CELL_VALUE_PATTERN.search(body)
+    if value is None:
+        return None
+    value = html.unescape(value.group(1))
+    if cell_type == "s":
+        return shared_strings[int(value)]
+    if cell_type == "b":
+        return value == "1"
+    if cell_type in ("str", "e"):
+        return value
+    number = float(value)
+    return int(number) if number.is_integer() and "E" not in value.upper() else number
+
+def serialize_cell(ref, attributes, value):
+    """
+    A <c> element for `value`, keeping the style of the cell it replaces.
+    """
+    style = CELL_STYLE_PATTERN.search(attributes or "")
+    style = f' s="{style.group(1)}"' if style else ""
+    if value is None or value == "":
+        return f'<c r="{ref}"{style}/>'
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{style} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{style}><v>{value}</v></c>'
+    text = xml_escape(ILLEGAL_XML_CHARACTERS.sub('', str(value)))
+    return f'<c r="{ref}"{style} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+class AnkiSheetWriteback:
+    """
+    Rewrites the Anki worksheet part so the anki_writeback_columns hold the new result values.
+    The part is streamed row by row; a row is only re-serialized when one of its mapped cells
+    differs from the new value, and every other byte of the sheet is copied as it was.
+    """
+
+    def __init__(self, package, sheet_part, values_by_note):
+        self.package = package
+        self.sheet_part = sheet_part
+        self.values_by_note = values_by_note
+        self.shared_strings = read_shared_strings(package)
+        self.note_letter = None
+        self.targets = None  # column letter -> Anki column
+        self.changed_cells = 0
+        self.changed_rows = 0
+        self.skipped_formulas = 0
+
+    def write(self, out):
+        pending = b""
+        with self.package.open(self.sheet_part) as stream:
+            for chunk in iter(lambda: stream.read(1 << 20), b""):
+                pending += chunk
+                start = 0
+                end = pending.find(b"</row>")
+                while end >= 0:
+                    end += len(b"</row>")
+                    out.write(self.rewrite_segment(pending[start:end]))
+                    start = end
+                    end = pending.find(b"</row>", start)
+                pending = pending[start:]
+        out.write(pending)
+
+    def rewrite_segment(self, segment):
+        """
+        `segment` ends with one complete row; anything before that row is passed through.
+        """
+        text = segment.decode("utf-8")
+        row_start = None
+        for row_start in ROW_START_PATTERN.finditer(text):
+            pass
+        if row_start is None:
+            return segment
+        row_open_end = text.index(">", row_start.start()) + 1
+        cells = [(match.group(2), match) for match in CELL_PATTERN.finditer(text, row_open_end)]
+        if self.targets is None:
+            self.resolve_header(cells)
+            return segment
+        values = self.values_by_note.get(self.cell_value(cells, self.note_letter))
+        if values is None:
+            return segment
+        row_number = ROW_NUMBER_PATTERN.search(text[row_start.start():row_open_end]).group(1)
+        cell_texts = {letter: match.group(0) for letter, match in cells}
+        changed = False
+        for letter, anki_column in self.targets.items():
+            match = next((match for cell_letter, match in cells if cell_letter == letter), None)
+            if match is not None and "<f" in (match.group(4) or ""):
+                self.skipped_formulas += 1
+                continue
+            current = self.cell_value(cells, letter)
+            new = values.get(anki_column)
+            if (current if current is not None else "") == (new if new is not None else ""):
+                continue
+            cell_texts[letter] = serialize_cell(f"{letter}{row_number}", match.group(1) if match else None, new)
+            self.changed_cells += 1
+            changed = True
+        if not changed:
+            return segment
+        self.changed_rows += 1
+        # Cells must stay in column order; spans is only a loading hint, so it is dropped
+        row_open = ROW_SPANS_PATTERN.sub("", text[row_start.start():row_open_end])
+        ordered = sorted(cell_texts.items(), key=lambda item: column_index_from_string(item[0]))
+        return (text[:row_start.start()] + row_open + "".join(cell for _, cell in ordered) + "</row>").encode("utf-8")
+
+    def resolve_header(self, cells):
+        headers = {self.raw_value(match): letter for letter, match in cells}
+        self.note_letter = headers.get("Note ID")
+        self.targets = {}
+        for anki_column in anki_writeback_columns:
+            if anki_column in ANKI_COLUMNS:
+                logging.warning(f"Write-back column '{anki_column}' is a matching input; skipped.")
+            elif anki_column not in headers:
+                logging.warning(f"Write-back column '{anki_column}' not found in the Anki sheet; skipped.")
+            else:
+                self.targets[headers[anki_column]] = anki_column
+
+    def raw_value(self, match):
+        return raw_cell_value(match.group(1), match.group(4), self.shared_strings)
+
+    def cell_value(self, cells, letter):
+        for cell_letter, match in cells:
+            if cell_letter == letter:
+                value = self.raw_value(match)
+                return str(value) if letter == self.note_letter and value is not None else value
+        return None
+
+def writeback_values(result_rows):
+    """
+    New Anki values per Note ID from {note key: result row}, following anki_writeback_columns.
+    """
+    return {
+        note_key: {anki_column: result.get(result_column) for anki_column, result_column in anki_writeback_columns.items()}
+        for note_key, result in result_rows.items()
+    }
+
+def copy_zip_entry_raw(source, target, item):
+    """
+    Copy one entry from `source` to `target` (both zipfile.ZipFile) without recompressing it.
+    The compressed bytes are read straight after the entry's local header, so the part is
+    carried over byte-for-byte.
+    """
+    source.fp.seek(item.header_offset)
+    # Fixed 30-byte local header; the name and extra field lengths are its last two fields
+    local_header = source.fp.read(ZIP_LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack("<HH", local_header[26:ZIP_LOCAL_HEADER_SIZE])
+    source.fp.seek(name_length + extra_length, 1)
+    compressed = source.fp.read(item.compress_size)
+    copied = copy.copy(item)
+    # Sizes and CRC go into the local header, so no trailing data descriptor (flag bit 3) is written
+    copied.flag_bits &= ~ZIP_DATA_DESCRIPTOR_FLAG
+    copied.header_offset = target.fp.tell()
+    target.fp.write(copied.FileHeader())
+    target.fp.write(compressed)
+    target.filelist.append(copied)
+    target.NameToInfo[copied.filename] = copied
+    target.start_dir = target.fp.tell()
+
+def write_package(source, output_path, replacements, additions=None):
+    """
+    Write a copy of the package `source` to `output_path`. Parts named in `replacements` get
+    new content, parts in `additions` are appended, every other part is copied raw.
+    Content is either bytes or a callable that writes to a binary file object.
+    """
+    def write_part(target, item, content):
+        if callable(content):
+            with target.open(item, "w", force_zip64=True) as out:
+                content(out)
+        else:
+            target.writestr(item, content)
+
+    date_time = datetime.now().timetuple()[:6]
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as target:
+        for item in source.infolist():
+            if item.filename in replacements:
+                # Keep the original timestamp so untouched workbooks do not look modified
+                replaced_item = zipfile.ZipInfo(item.filename, date_time=item.date_time)
+                replaced_item.compress_type = zipfile.ZIP_DEFLATED
+                write_part(target, replaced_item, replacements[item.filename])
+            else:
+                copy_zip_entry_raw(source, target, item)
+        for part, content in (additions or {}).items():
+            added_item = zipfile.ZipInfo(part, date_time=date_time)
+            added_item.compress_type = zipfile.ZIP_DEFLATED
+            write_part(target, added_item, content)
+
+def next_part_name(names, pattern):
+    """
+    First part name from `pattern` (e.g. "xl/tables/table{}.xml") not already in the package.
+    """
+    number = 1
+    while pattern.format(number) in names:
+        number += 1
+    return pattern.format(number)
+
+def insert_before_closing_tag(xml_bytes, tag, fragment):
+    """
+    Insert `fragment` before the closing tag of the (possibly prefixed) element `tag`.
+    Works on the text so that namespace prefixes and mc:Ignorable declarations stay intact.
+    `fragment` is called with the element's prefix ("" or e.g. "x:").
+    """
+    text = xml_bytes.decode("utf-8")
+    closing = re.search(rf"</((?:[\w.-]+:)?){tag}>", text)
+    if closing is None:
+        raise ValueError(f"No closing </{tag}> element found")
+    return (text[:closing.start()] + fragment(closing.group(1)) + text[closing.start():]).encode("utf-8")
+
+def sheet_rels_xml(table_rel_id, table_part, sheet_part):
+    """
+    Relationships part of the Results worksheet: a single relationship to its table.
+    """
+    target = posixpath.relpath(table_part, posixpath.dirname(sheet_part))
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        f'<Relationship Id="{table_rel_id}" Type="{RELATIONSHIPS_NAMESPACE}/table" Target="{target}"/>'
+        '</Relationships>'
+    ).encode("utf-8")
+
+def patch_results_package(writer, xlsm_path, sheet_name, package_edits=None):
+    """
+    Replace only the worksheet and table parts of `sheet_name` inside the XLSM package,
+    adding the sheet (workbook, relationships and content types entries) if it does not exist.
+    Every other part, including the VBA project, is copied byte-for-byte unless
+    `package_edits(package)` returns replacement content for it.
+    """
+    output_path = xlsm_path + ".new"
+    with zipfile.ZipFile(xlsm_path) as source:
+        names = set(source.namelist())
+        replacements = {}
+        additions = {}
+        content_types = source.read("[Content_Types].xml")
+        content_types_changed = False
+
+        sheet_part = find_sheet_part(source, sheet_name)
+        if sheet_part is None:
+            sheet_part = next_part_name(names, "xl/worksheets/sheet{}.xml")
+            workbook_xml = source.read("xl/workbook.xml")
+            workbook_rels = source.read("xl/_rels/workbook.xml.rels")
+            sheet_ids = [int(value) for value in re.findall(rb'sheetId="(\d+)"', workbook_xml)]
+            rel_numbers = [int(value) for value in re.findall(rb'Id="rId(\d+)"', workbook_rels)]
+            sheet_rel_id = f"rId{max(rel_numbers, default=0) + 1}"
+            prefix_match = re.search(rb'xmlns:([\w.-]+)="' + re.escape(RELATIONSHIPS_NAMESPACE.encode()) + rb'"', workbook_xml)
+            r_prefix = prefix_match.group(1).decode() if prefix_match else "r"
+            if prefix_match is None:
+                workbook_xml = workbook_xml.replace(b"<workbook ", f'<workbook xmlns:r="{RELATIONSHIPS_NAMESPACE}" '.encode(), 1)
+            replacements["xl/workbook.xml"] = insert_before_closing_tag(
+                workbook_xml, "sheets",
+                lambda prefix: f'<{prefix}sheet name={xml_quoteattr(sheet_name)} '
+                               f'sheetId="{max(sheet_ids, default=0) + 1}" {r_prefix}:id="{sheet_rel_id}"/>'
+            )
+            replacements["xl/_rels/workbook.xml.rels"] = insert_before_closing_tag(
+                workbook_rels, "Relationships",
+                lambda prefix: f'<{prefix}Relationship Id="{sheet_rel_id}" Type="{RELATIONSHIPS_NAMESPACE}/worksheet" '
+                               f'Target="{posixpath.relpath(sheet_part, "xl")}"/>'
+            )
+            content_types = insert_before_closing_tag(
+                content_types, "Types",
+                lambda prefix: f'<{prefix}Override PartName="/{sheet_part}" ContentType='
+                               '"application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            )
+            content_types_changed = True
+            table_part = None
+        elif rels_part(sheet_part) in names:
+            _, table_part = find_table_part(source, sheet_part)
+        else:
+            table_part = None
+
+        if table_part is not None:
+            table_id = ElementTree.fromstring(source.read(table_part)).get("id")
+        else:
+            table_part = next_part_name(names, "xl/tables/table{}.xml")
+            table_ids = [
+                int(ElementTree.fromstring(source.read(part)).get("id"))
+                for part in names if part.startswith("xl/tables/") and part.endswith(".xml")
+            ]
+            table_id = max(table_ids, default=0) + 1
+            content_types = insert_before_closing_tag(
+                content_types, "Types",
+                lambda prefix: f'<{prefix}Override PartName="/{table_part}" ContentType='
+                               '"application/vnd.openxmlformats-officedocument.spreadsheetml.table+xml"/>'
+            )
+            content_types_changed = True
+        if content_types_changed:
+            replacements["[Content_Types].xml"] = content_types
+
+        # The regenerated sheet references nothing but its table
+        table_rel_id = "rId1"
+        parts = {
+            sheet_part: lambda out: writer.write_sheet(out, table_rel_id),
+            rels_part(sheet_part): sheet_rels_xml(table_rel_id, table_part, sheet_part),
+            table_part: writer.table_xml(table_id, "Results"),
+        }
+        for part, content in parts.items():
+            (replacements if part in names else additions)[part] = content
+        if package_edits is not None:
+            replacements.update(package_edits(source))
+
+        write_package(source, output_path, replacements, additions)
+    os.replace(output_path, xlsm_path)
+
+def rewrite_results_workbook(writer, xlsm_path, sheet_name, package_edits=None):
+    """
+    Let openpyxl rewrite the workbook around an empty placeholder sheet, then swap in the
+    streamed worksheet and table parts.
+    """
+    wb = load_workbook(xlsm_path, keep_vba=True)
+    # Remove old Results sheet if it exists
+    if sheet_name in wb.sheetnames:
+        wb.remove(wb[sheet_name])
+    # Placeholder sheet: header row and table only, the rows are spliced in below
+    ws = wb.create_sheet(title=sheet_name)
+    ws.append(RESULT_COLUMNS)
+    last_col_letter = get_column_letter(len(RESULT_COLUMNS))
+    table = Table(displayName="Results", ref=f"A1:{last_col_letter}1")
+    ws.add_table(table)
+    placeholder_path = xlsm_path + ".tmp"
+    wb.save(placeholder_path)
+
+    output_path = xlsm_path + ".new"
+    with zipfile.ZipFile(placeholder_path) as source:
+        sheet_part = find_sheet_part(source, sheet_name)
+        table_rel_id, table_part = find_table_part(source, sheet_part)
+        table_id = ElementTree.fromstring(source.read(table_part)).get("id")
+        replacements = {
+            sheet_part: lambda out: writer.write_sheet(out, table_rel_id),
+            table_part: writer.table_xml(table_id, "Results"),
+        }
+        if package_edits is not None:
+            replacements.update(package_edits(source))
+        write_package(source, output_path, replacements)
+    os.remove(placeholder_path)
+    os.replace(output_path, xlsm_path)
+
+def result_note_key(result):
+    """
+    Note key (the Note ID as a string, as in the reconcile state) of a result row, or None.
+    """
+    note_id = result.get("Note ID")
+    return None if note_id is None or note_id == "" else str(note_id)
+
+class ResultSink:
+    """
+    Destination for result rows. Rows arrive one at a time through write(); close() finishes
+    the output and abort() discards it after a failed run, leaving the previous output in place.
+    A sink with `merge` set keeps its previous output: written rows replace the rows with the
+    same Note ID and remove() deletes rows, so it can be fed only the delta of a run.
+    """
+    name = None
+    merge = False
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, result):
+        self.count += 1
+
+    def remove(self, note_keys):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+class FileResultSink(ResultSink):
+    """
+    Sink writing to a temporary file that replaces `path` on close.
+    With `merge`, keyed rows are held until close and merged into the rows of the existing
+    file: changed rows take the place of their old version, new ones are appended, removed
+    rows and rows without a Note ID are dropped.
+    Subclasses define write_row(result), which writes one result to self.file, and
+    read_rows(file), which yields the rows of an existing output file as {column: value} dicts.
+    """
+
+    def __init__(self, path, newline=None, encoding='utf-8', merge=False):
+        super().__init__()
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.newline = newline
+        self.encoding = encoding
+        # Without an existing file there is nothing to merge into; every row is written
+        self.merge = merge and os.path.exists(path)
+        self.pending = {}
+        self.unkeyed = []
+        self.removed = set()
+        self.file = open(self.temp_path, 'w', encoding=encoding, newline=newline)
+
+    def write(self, result):
+        super().write(result)
+        if not self.merge:
+            self.write_row(result)
+        elif result_note_key(result) is None:
+            self.unkeyed.append(result)
+        else:
+            self.pending[result_note_key(result)] = result
+
+    def remove(self, note_keys):
+        self.removed.update(note_keys)
+
+    def merge_existing(self):
+        """
+        Write the rows of the existing file, replaced or dropped as recorded, then the new rows.
+        """
+        kept = 0
+        with open(self.path, 'r', encoding=self.encoding, newline=self.newline) as file:
+            for result in self.read_rows(file):
+                note_key = result_note_key(result)
+                if note_key is None or note_key in self.removed:
+                    continue
+                self.write_row(self.pending.pop(note_key, result))
+                kept += 1
+        for result in itertools.chain(self.pending.values(), self.unkeyed):
+            self.write_row(result)
+        return kept + len(self.pending) + len(self.unkeyed)
+
+    def close(self):
+        if self.merge:
+            total = self.merge_existing()
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        if self.merge:
+            logging.info(f"Merged {self.count} changed and {len(self.removed)} removed results into {self.path} ({total} rows)")
+        else:
+            logging.info(f"Wrote {self.count} results to {self.path}")
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class CsvResultSink(FileResultSink):
+    name = "csv"
+
+    def __init__(self, path, merge=False):
+        # utf-8-sig so Excel opens the Cyrillic text correctly
+        super().__init__(path, newline='', encoding='utf-8-sig', merge=merge)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(RESULT_COLUMNS)
+
+    def write_row(self, result):
+        self.writer.writerow([result.get(column) for column in RESULT_COLUMNS])
+
+    def read_rows(self, file):
+        # Rows are read by header name, so files written with other columns still merge
+        return csv.DictReader(file)
+
+class JsonlResultSink(FileResultSink):
+    name = "jsonl"
+
+    def write_row(self, result):
+        self.file.write(json.dumps({column: result.get(column) for column in RESULT_COLUMNS}, ensure_ascii=False))
+        self.file.write("\n")
+
+    def read_rows(self, file):
+        return (json.loads(line) for line in file if line.strip())
+
+def typed_result_value(column, value):
+    """
+    Result value coerced to the column's type in RESULT_COLUMN_TYPES (str unless listed).
+    """
+    if value is None:
+        return None
+    if RESULT_COLUMN_TYPES.get(column) is int:
+        return value if isinstance(value, int) else int(value)
+    return value if isinstance(value, str) else str(value)
+
+class ParquetResultSink(ResultSink):
+    """
+    Parquet file written in row groups of result_sink_batch_size rows (requires pyarrow).
+    """
+    name = "parquet"
+
+    def __init__(self, path):
+        super().__init__()
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for the parquet result sink")
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.schema = pyarrow.schema([
+            (column, pyarrow.int64() if RESULT_COLUMN_TYPES.get(column) is int else pyarrow.string())
+            for column in RESULT_COLUMNS
+        ])
+        self.writer = pyarrow_parquet.ParquetWriter(self.temp_path, self.schema)
+        self.batch = []
+
+    def write(self, result):
+        super().write(result)
+        self.batch.append(result)
+        if len(self.batch) >= result_sink_batch_size:
+            self.flush()
+
+    def flush(self):
+        columns = {
+            column: [typed_result_value(column, result.get(column)) for result in self.batch]
+            for column in RESULT_COLUMNS
+        }
+        self.writer.write_table(pyarrow.table(columns, schema=self.schema))
+        self.batch = []
+
+    def close(self):
+        if self.batch:
+            self.flush()
+        self.writer.close()
+        os.replace(self.temp_path, self.path)
+        logging.info(f"Wrote {self.count} results to {self.path}")
+
+    def abort(self):
+        self.writer.close()
+        os.remove(self.temp_path)
+
+class SqliteResultSink(ResultSink):
+    """
+    'results' table in a SQLite database, replaced inside a single transaction.
+    With `merge`, the existing table is kept: written rows replace the rows with the same
+    Note ID, removed rows are deleted, and rows without a Note ID are replaced as a whole.
+    """
+    name = "sqlite"
+
+    def __init__(self, path, table_name="results", merge=False):
+        super().__init__()
+        self.path = path
+        self.table_name = table_name
+        self.connection = sqlite3.connect(path)
+        quoted_columns = [f'"{column}"' for column in RESULT_COLUMNS]
+        column_definitions = ", ".join(
+            f'{quoted} {"INTEGER" if RESULT_COLUMN_TYPES.get(column) is int else "TEXT"}'
+            for quoted, column in zip(quoted_columns, RESULT_COLUMNS)
+        )
+        self.insert_sql = (f'INSERT INTO "{table_name}" ({", ".join(quoted_columns)}) '
+                           f'VALUES ({", ".join("?" * len(RESULT_COLUMNS))})')
+        self.delete_sql = f'DELETE FROM "{table_name}" WHERE "Note ID" = ?'
+        self.removed = 0
+        self.connection.execute("BEGIN")
+        existing_columns = [row[1] for row in self.connection.execute(f'PRAGMA table_info("{table_name}")')]
+        if merge and existing_columns and existing_columns != RESULT_COLUMNS:
+            logging.warning(f"Table '{table_name}' in {path} has other columns; it is rebuilt with every result.")
+        self.merge = merge and existing_columns == RESULT_COLUMNS
+        if self.merge:
+            self.connection.execute(f'DELETE FROM "{table_name}" WHERE "Note ID" IS NULL')
+        else:
+            self.connection.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            self.connection.execute(f'CREATE TABLE "{table_name}" ({column_definitions})')
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{table_name}_note_id" ON "{table_name}" ("Note ID")')
+        self.batch = []
+
+    def write(self, result):
+        super().write(result)
+        self.batch.append([typed_result_value(column, result.get(column)) for column in RESULT_COLUMNS])
+        if len(self.batch) >= result_sink_batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.merge:
+            note_id_position = RESULT_COLUMNS.index("Note ID")
+            self.connection.executemany(
+                self.delete_sql, [(row[note_id_position],) for row in self.batch if row[note_id_position] is not None]
+            )
+        self.connection.executemany(self.insert_sql, self.batch)
+        self.batch = []
+
+    def remove(self, note_keys):
+        cursor = self.connection.executemany(
+            self.delete_sql, [(typed_result_value("Note ID", note_key),) for note_key in note_keys]
+        )
+        self.removed += cursor.rowcount
+
+    def close(self):
+        if self.batch:
+            self.flush()
+        self.connection.commit()
+        self.connection.close()
+        if self.merge:
+            logging.info(f"Merged {self.count} changed and {self.removed} removed results into table "
+                         f"'{self.table_name}' in {self.path}")
+        else:
+            logging.info(f"Wrote {self.count} results to table '{self.table_name}' in {self.path}")
+
+    def abort(self):
+        self.connection.rollback()
+        self.connection.close()
+
+class XlsmResultSink(ResultSink):
+    """
+    The 'Results' worksheet of the existing Flashcards.xlsm, with macros preserved, formatted as a
+    table with auto-fit columns. Rows are streamed into the worksheet part, which close() places
+    into the package according to xlsm_write_mode. `package_edits(package)` may return further
+    {part: content} replacements, which are written in the same save. close() records the part
+    CRCs of the workbook it rewrote in `source_crcs`.
+    """
+    name = "xlsm"
+
+    def __init__(self, xlsm_path, sheet_name="Results", package_edits=None):
+        super().__init__()
+        self.xlsm_path = xlsm_path
+        self.sheet_name = sheet_name
+        self.package_edits = package_edits
+        self.source_crcs = None
+        logging.info(f"Streaming results to '{sheet_name}' in {xlsm_path} ({xlsm_write_mode} mode)")
+        self.writer = ResultsSheetWriter(RESULT_COLUMNS)
+
+    def write(self, result):
+        super().write(result)
+        self.writer.append([result.get(column) for column in RESULT_COLUMNS])
+
+    def close(self):
+        try:
+            self.source_crcs = package_part_crcs(self.xlsm_path)
+            if xlsm_write_mode == "patch":
+                patch_results_package(self.writer, self.xlsm_path, self.sheet_name, self.package_edits)
+            else:
+                rewrite_results_workbook(self.writer, self.xlsm_path, self.sheet_name, self.package_edits)
+        finally:
+            self.writer.close()
+        logging.info(f"Wrote {self.count} results to {self.xlsm_path} in sheet '{self.sheet_name}' (as table)")
+
+    def abort(self):
+        self.writer.close()
+
+class ResultsDiff:
+    """
+    Run-over-run comparison of result rows keyed by Note ID.
+    Rows are compared by result fingerprint first; only rows whose fingerprint moved are
+    compared column by column. Added and changed rows are streamed to results_diff_path as
+    they are recorded, removed rows are appended by finish().
+    """
+
+    def __init__(self, previous_rows):
+        self.previous_rows = previous_rows
+        self.seen = set()
+        self.counts = {"added": 0, "removed": 0, "changed": 0, "unchanged": 0}
+        self.column_counts = {}
+        self.temp_path = results_diff_path + ".tmp"
+        self.file = open(self.temp_path, 'w', encoding='utf-8')
+
+    def record(self, note_key, result, result_fp):
+        """
+        Compare one row with the previous run. Returns True if it was added or changed.
+        """
+        self.seen.add(note_key)
+        previous = self.previous_rows.get(note_key)
+        if previous is None:
+            self.counts["added"] += 1
+            self.emit({"change": "added", "Note ID": result.get("Note ID"), "after": result})
+            return True
+        if (previous.get("result_fp") or fingerprint(previous["result"])) == result_fp:
+            self.counts["unchanged"] += 1
+            return False
+        before = previous["result"]
+        columns = [column for column in RESULT_COLUMNS if before.get(column) != result.get(column)]
+        if not columns:
+            # Only columns outside RESULT_COLUMNS differed (e.g. state from an older version)
+            self.counts["unchanged"] += 1
+            return False
+        self.counts["changed"] += 1
+        for column in columns:
+            self.column_counts[column] = self.column_counts.get(column, 0) + 1
+        self.emit({
+            "change": "changed",
+            "Note ID": result.get("Note ID"),
+            "columns": columns,
+            "before": {column: before.get(column) for column in columns},
+            "after": {column: result.get(column) for column in columns},
+        })
+        return True
+
+    def emit(self, change):
+        self.file.write(json.dumps(change, ensure_ascii=False))
+        self.file.write("\n")
+
+    def removed_keys(self):
+        """
+        Note keys of the previous run that no row of this run carried; complete once every row is recorded.
+        """
+        return [note_key for note_key in self.previous_rows if note_key not in self.seen]
+
+    def finish(self):
+        """
+        Append the removed rows, move the diff file into place and log the summary.
+        """
+        for note_key in self.removed_keys():
+            previous = self.previous_rows[note_key]
+            self.counts["removed"] += 1
+            self.emit({"change": "removed", "Note ID": previous["result"].get("Note ID"), "before": previous["result"]})
+        self.file.close()
+        os.replace(self.temp_path, results_diff_path)
+        logging.info(
+            f"Results diff: {self.counts['added']} added, {self.counts['removed']} removed, "
+            f"{self.counts['changed']} changed, {self.counts['unchanged']} unchanged; details in {results_diff_path}"
+        )
+        for column, count in sorted(self.column_counts.items(), key=lambda item: -item[1]):
+            logging.info(f"  {column}: changed in {count} rows")
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+class DeltaOnlySink(ResultSink):
+    """
+    Passes only added and changed rows (per `is_delta(result)`) on to the wrapped sink, which
+    was opened with merge=True, and on close has it delete the rows of `removed_keys()`.
+    A wrapped sink without previous output to merge into receives every row.
+    """
+
+    def __init__(self, sink, is_delta, removed_keys):
+        super().__init__()
+        self.sink = sink
+        self.name = sink.name
+        self.is_delta = is_delta
+        self.removed_keys = removed_keys
+
+    def write(self, result):
+        super().write(result)
+        if not self.sink.merge or self.is_delta(result):
+            self.sink.write(result)
+
+    def close(self):
+        if self.sink.merge:
+            self.sink.remove(self.removed_keys())
+        self.sink.close()
+
+    def abort(self):
+        self.sink.abort()
+
+def open_result_sinks(package_edits=None, merge_sinks=()):
+    """
+    Open one sink per entry of result_sinks; a sink that cannot be opened is logged and skipped.
+    Sinks named in `merge_sinks` are opened to merge into their previous output where they support it.
+    """
+    factories = {
+        "xlsm": lambda merge: XlsmResultSink(flashcards_xlsm_path, "Results", package_edits),
+        "csv": lambda merge: CsvResultSink(results_csv_path, merge=merge),
+        "jsonl": lambda merge: JsonlResultSink(results_jsonl_path, merge=merge),
+        "parquet": lambda merge: ParquetResultSink(results_parquet_path),
+        "sqlite": lambda merge: SqliteResultSink(results_sqlite_path, merge=merge),
+    }
+    mergeable = {"csv", "jsonl", "sqlite"}
+    sinks = []
+    for name in result_sinks:
+        if name not in factories:
+            logging.error(f"Unknown result sink: {name}")
+            continue
+        if name in merge_sinks and name not in mergeable:
+            logging.warning(f"The {name} result sink cannot merge a delta; it receives every row.")
+        try:
+            sinks.append(factories[name](name in merge_sinks and name in mergeable))
+        except Exception as e:
+            logging.error(f"Could not open the {name} result sink: {e}")
+    return sinks
+
+def abort_result_sink(sink):
+    """
+    Abort `sink`, logging rather than raising any failure.
+    """
+    try:
+        sink.abort()
+    except Exception as e:
+        logging.error(f"Exception aborting {sink.name} result sink: {e}", exc_info=True)
+
+def write_results(results, sinks):
+    """
+    Feed every result from the `results` generator to all sinks, then close them.
+    If producing or writing a row fails, every sink is aborted and the exception re-raised.
+    A sink that fails to close is aborted so its previous output stays in place.
+    Returns the names of the sinks that closed successfully; callers must not treat the run
+    as written unless every sink is among them.
+    """
+    try:
+        for result in results:
+            for sink in sinks:
+                sink.write(result)
+    except Exception:
+        for sink in sinks:
+            abort_result_sink(sink)
+        raise
+    closed = []
+    for sink in sinks:
+        try:
+            sink.close()
+            closed.append(sink.name)
+        except Exception as e:
+            logging.error(f"Exception closing {sink.name} result sink: {e}", exc_info=True)
+            abort_result_sink(sink)
+    return closed
+
+def levenshtein(a, b, bound=None):
+    """
+    Edit distance (insertions, deletions, substitutions) between two strings.
+    With `bound`, any distance above it is reported as bound + 1, which lets the computation
+    stop at the length difference or at the first row whose every cell exceeds the bound.
+    """
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if bound is not None and len(a) - len(b) > bound:
+        return bound + 1
+    previous_row = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current_row = [i]
+        for j, char_b in enumerate(b, 1):
+            current_row.append(min(
+                previous_row[j] + 1,
+                current_row[j - 1] + 1,
+                previous_row[j - 1] + (char_a != char_b)
+            ))
+        # Row minima never decrease, so the final distance is at least this row's minimum
+        if bound is not None and min(current_row) > bound:
+            return bound + 1
+        previous_row = current_row
+    if bound is not None and previous_row[-1] > bound:
+        return bound + 1
+    return previous_row[-1]
+
+class BKTree:
+    """
+    Burkhard-Keller tree over strings under Levenshtein distance.
+    Each node is [term, payloads, children keyed by distance to the node term].
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+        self.last_visited = 0
+
+    def add(self, term, payload):
+        if self.root is None:
+            self.root = [term, [payload], {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(term, node[0])
+            if distance == 0:
+                if payload not in node[1]:
+                    node[1].append(payload)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [term, [payload], {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, term, max_distance):
+        """
+        Return (distance, term, payloads) for every stored term within max_distance, closest first.
+        Subtrees outside [d - max_distance, d + max_distance] are pruned by the triangle inequality;
+        the number of nodes compared is left in last_visited.
+        A node's distance is only computed up to max_distance plus its largest child edge: beyond
+        that the node is no match and every child is pruned anyway.
+        """
+        matches = []
+        self.last_visited = 0
+        if self.root is None:
+            return matches
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            self.last_visited += 1
+            distance = levenshtein(term, node[0], max_distance + max(node[2], default=0))
+            if distance <= max_distance:
+                matches.append((distance, node[0], node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: (match[0], match[1]))
+        return matches
+
+def extract_headword(rom):
+    """
+    Plain headword of a rom: the headword field, or headword_full without markup and syllable marks.
+    """
+    headword = rom.get("headword")
+    if not headword:
+        headword = re.sub(r'<span class="[^"]*">.*?</span>|<[^>]+>', '', rom.get("headword_full", ""))
+        headword = headword.replace("|", "")
+    return headword.strip()
+
+def strip_stress(text):
+    """
+    Remove stress accents (every combining mark but the breve of й) and "|" syllable marks.
+    """
+    decomposed = unicodedata.normalize("NFD", str(text))
+    stripped = "".join(
+        char for char in decomposed
+        if not unicodedata.combining(char) or char == COMBINING_BREVE
+    )
+    return unicodedata.normalize("NFC", stripped).replace("|", "")
+
+def normalize_key(text):
+    """
+    Accent- and syllable-mark-insensitive key for comparing flashcards with PONS values:
+    NFD, drop combining marks (but keep the breve of й), drop "|", casefold, collapse whitespace.
+    """
+    if not text:
+        return ""
+    return " ".join(strip_stress(text).casefold().split())
+
+def load_markup_catalogue(path):
+    """
+    Read the (tag, class) targets listed in the "Target Element" column of Process.csv,
+    e.g. "span:genus" -> ("span", "genus"), "sup" -> ("sup", None).
+    Returns None (keep every classed element) if the catalogue cannot be read.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8-sig', newline='') as file:
+            targets = set()
+            for row in csv.DictReader(file):
+                element = (row.get("Target Element") or "").strip()
+                if element:
+                    tag, _, element_class = element.partition(":")
+                    targets.add((tag, element_class or None))
+    except Exception as e:
+        logging.warning(f"Could not read the markup catalogue from {path}: {e}; keeping every classed element.")
+        return None
+    # Acronyms are catalogued by title; their values are collected under "acronym"
+    return frozenset((tag, None) if tag == "acronym" else (tag, element_class) for tag, element_class in targets)
+
+class MarkupParser:
+    """
+    Single-pass parser for the HTML fragments PONS puts in headword_full, header, source and target.
+    parse() returns the fragment's plain text and a {class: (texts...)} mapping of the catalogued
+    elements, with acronyms read as their titles and entities unescaped. Results are memoized
+    per fragment, since the same fragments recur across thousands of entries.
+    """
+
+    def __init__(self, catalogue):
+        self.catalogue = catalogue
+        self.cache = {}
+
+    def wanted(self, tag, element_class):
+        if self.catalogue is None:
+            return element_class is not None or tag == "acronym"
+        return (tag, element_class) in self.catalogue
+
+    def parse(self, fragment):
+        if not fragment:
+            return "", EMPTY_ATTRIBUTES
+        cached = self.cache.get(fragment)
+        if cached is None:
+            cached = self.cache[fragment] = self.parse_uncached(fragment)
+        return cached
+
+    def parse_uncached(self, fragment):
+        attributes = {}
+        # Frames: [tag, class, acronym title, text parts]
+        stack = [[None, None, None, []]]
+        position = 0
+        for match in MARKUP_TAG_PATTERN.finditer(fragment):
+            stack[-1][3].append(fragment[position:match.start()])
+            position = match.end()
+            closing, tag, tag_attributes, self_closing = match.groups()
+            tag = tag.lower()
+            if self_closing or tag in VOID_TAGS:
+                continue
+            if not closing:
+                element_class = MARKUP_CLASS_PATTERN.search(tag_attributes)
+                title = MARKUP_TITLE_PATTERN.search(tag_attributes) if tag == "acronym" else None
+                stack.append([
+                    tag,
+                    element_class.group(1) if element_class else None,
+                    html.unescape(title.group(1)) if title else None,
+                    []
+                ])
+                continue
+            # Close the innermost matching element; stray closing tags are ignored
+            if not any(frame[0] == tag for frame in stack[1:]):
+                continue
+            while True:
+                frame_tag, element_class, title, parts = stack.pop()
+                text = title if title is not None else "".join(parts)
+                stack[-1][3].append(text)
+                key = "acronym" if frame_tag == "acronym" else element_class or frame_tag
+                if self.wanted(frame_tag, None if frame_tag == "acronym" else element_class):
+                    value = " ".join(html.unescape(text).split())
+                    if value:
+                        attributes.setdefault(key, []).append(value)
+                if frame_tag == tag:
+                    break
+        stack[-1][3].append(fragment[position:])
+        while len(stack) > 1:
+            _, _, title, parts = stack.pop()
+            stack[-1][3].append(title if title is not None else "".join(parts))
+        text = " ".join(html.unescape("".join(stack[0][3])).split())
+        return text, {key: tuple(values) for key, values in attributes.items()}
+
+class TranslationRecord:
+    """
+    One source/target pair of an arab, with the catalogued attributes of each side.
+    """
+    __slots__ = ("source", "target", "source_text", "target_text", "source_attributes", "target_attributes")
+
+    def __init__(self, source, target, source_text, target_text, source_attributes, target_attributes):
+        self.source = source
+        self.target = target
+        self.source_text = source_text
+        self.target_text = target_text
+        self.source_attributes = source_attributes
+        self.target_attributes = target_attributes
+
+class ArabRecord:
+    """
+    One sense block of a rom: its header and translations.
+    """
+    __slots__ = ("header", "header_text", "attributes", "translations")
+
+    def __init__(self, header, header_text, attributes, translations):
+        self.header = header
+        self.header_text = header_text
+        self.attributes = attributes
+        self.translations = translations
+
+class RomRecord:
+    """
+    One rom (headword block) with the attributes of headword_full (wordclass, genus, flexion,
+    conjugation, ...) and its parsed arabs. Some responses also carry rom-level header, source
+    and examples fields; their attributes (and the raw examples) are kept as well.
+    """
+    __slots__ = (
+        "headword", "headword_full", "headword_text", "attributes",
+        "header_attributes", "source_attributes", "examples", "arabs"
+    )
+
+    def __init__(self, headword, headword_full, headword_text, attributes,
+                 header_attributes, source_attributes, examples, arabs):
+        self.headword = headword
+        self.headword_full = headword_full
+        self.headword_text = headword_text
+        self.attributes = attributes
+        self.header_attributes = header_attributes
+        self.source_attributes = source_attributes
+        self.examples = examples
+        self.arabs = arabs
+
+    @property
+    def wordclass(self):
+        values = self.attributes.get("wordclass")
+        return values[0] if values else None
+
+    def iter_attribute(self, element_class):
+        """
+        Values of `element_class` in header order: rom header, arab headers, rom source,
+        translation sources.
+        """
+        parts = [self.header_attributes] + [arab.attributes for arab in self.arabs] + [self.source_attributes]
+        for attributes in parts:
+            yield from attributes.get(element_class, ())
+        for arab in self.arabs:
+            for translation in arab.translations:
+                yield from translation.source_attributes.get(element_class, ())
+
+class ParsedEntry:
+    """
+    concatenated.json entry with every rom, arab and translation parsed.
+    """
+    __slots__ = ("query", "error", "roms")
+
+    def __init__(self, query, error, roms):
+        self.query = query
+        self.error = error
+        self.roms = roms
+
+def parse_entry(json_entry, parser):
+    """
+    Parse one concatenated.json entry in a single traversal.
+    """
+    data = json_entry.get("data", {})
+    error = data.get("error") if isinstance(data, dict) else None
+    roms = []
+    for rom in extract_roms(data):
+        arabs = []
+        for arab in rom.get("arabs") or []:
+            translations = []
+            for translation in arab.get("translations") or []:
+                source, target = translation.get("source") or "", translation.get("target") or ""
+                source_text, source_attributes = parser.parse(source)
+                target_text, target_attributes = parser.parse(target)
+                translations.append(TranslationRecord(
+                    source, target, source_text, target_text, source_attributes, target_attributes
+                ))
+            header = arab.get("header") or ""
+            header_text, header_attributes = parser.parse(header)
+            arabs.append(ArabRecord(header, header_text, header_attributes, tuple(translations)))
+        headword_full = rom.get("headword_full") or ""
+        headword_text, attributes = parser.parse(headword_full)
+        roms.append(RomRecord(
+            extract_headword(rom), headword_full, headword_text, attributes,
+            parser.parse(rom.get("header") or "")[1], parser.parse(rom.get("source") or "")[1],
+            tuple(rom.get("examples") or ()), tuple(arabs)
+        ))
+    return ParsedEntry(json_entry.get("query"), error, tuple(roms))
+
+def parse_corpus(concatenated_data):
+    """
+    Parse every entry with a parser built from the Process.csv catalogue.
+    """
+    parser = MarkupParser(load_markup_catalogue(markup_catalogue_path))
+    parsed = [parse_entry(json_entry, parser) for json_entry in concatenated_data]
+    logging.info(f"Parsed {len(parsed)} entries ({len(parser.cache)} distinct markup fragments).")
+    return parsed
+
+def parsed_corpus_key():
+    """
+    Identity of the raw store and catalogue a parsed corpus was built from.
+    """
+    stat = os.stat(concatenated_file_path)
+    catalogue_sha1 = file_sha1(markup_catalogue_path) if os.path.exists(markup_catalogue_path) else None
+    return [parsed_corpus_version, stat.st_size, stat.st_mtime_ns, catalogue_sha1]
+
+def load_parsed_corpus(concatenated_data):
+    """
+    The parsed corpus from the cache next to concatenated.json, or parsed afresh (and cached)
+    when concatenated.json or Process.csv changed.
+    """
+    key = parsed_corpus_key()
+    if os.path.exists(parsed_corpus_path):
+        try:
+            with open(parsed_corpus_path, 'rb') as file:
+                cached_key, parsed = pickle.load(file)
+            if cached_key == key:
+                logging.info(f"Loaded {len(parsed)} parsed entries from {parsed_corpus_path}.")
+                return parsed
+        except Exception as e:
+            logging.warning(f"Could not read the parsed corpus from {parsed_corpus_path}: {e}")
+    parsed = parse_corpus(concatenated_data)
+    try:
+        with open(parsed_corpus_path + ".tmp", 'wb') as file:
+            pickle.dump((key, parsed), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(parsed_corpus_path + ".tmp", parsed_corpus_path)
+    except Exception as e:
+        logging.error(f"Exception saving the parsed corpus: {e}", exc_info=True)
+    return parsed
+
+class AcronymExpander:
+    """
+    Span-class-aware acronym expansion compiled from Acronyms.json.
+    A single tokenizing pattern walks a fragment once, tracking the enclosing span classes;
+    each <acronym> is replaced by the title catalogued for (innermost span class, content),
+    falling back to the tag's own title attribute. Expanded fragments are memoized.
+    """
+
+    def __init__(self, table):
+        # (span class, acronym content) -> title
+        self.table = table
+        self.classes = frozenset(span_class for span_class, _ in table)
+        self.cache = {}
+        self.expanded = 0
+        self.unknown = 0
+
+    @classmethod
+    def from_json(cls, path):
+        table = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                for group in json.load(file):
+                    for child in group.get("children", []):
+                        table[(group["span class"], child["Acronym Content"])] = child["Acronym Title"]
+        except Exception as e:
+            logging.warning(f"Could not read acronyms from {path}: {e}; using the title attributes only.")
+        return cls(table)
+
+    def expand(self, fragment):
+        """
+        `fragment` with every acronym replaced by its expansion; other markup is kept.
+        """
+        if not fragment or "<acronym" not in fragment:
+            return fragment
+        expanded = self.cache.get(fragment)
+        if expanded is None:
+            if len(self.cache) >= acronym_cache_size:
+                self.cache.clear()
+            expanded = self.cache[fragment] = ACRONYM_TOKEN_PATTERN.sub(self.token_replacer(), fragment)
+        return expanded
+
+    def token_replacer(self):
+        span_classes = []
+
+        def replace(match):
+            span_attributes, acronym_attributes, content = match.groups()
+            if span_attributes is not None:
+                element_class = MARKUP_CLASS_PATTERN.search(span_attributes)
+                span_classes.append(element_class.group(1) if element_class else None)
+                return match.group(0)
+            if acronym_attributes is None:
+                if span_classes:
+                    span_classes.pop()
+                return match.group(0)
+            for span_class in reversed(span_classes):
+                if span_class in self.classes and (span_class, content) in self.table:
+                    self.expanded += 1
+                    return html.escape(self.table[(span_class, content)], quote=False)
+            title = MARKUP_TITLE_PATTERN.search(acronym_attributes)
+            if title:
+                self.expanded += 1
+                return title.group(1)
+            self.unknown += 1
+            return content
+
+        return replace
+
+    def expand_value(self, value):
+        """
+        Expand acronyms in every string of a nested JSON value.
+        """
+        if isinstance(value, str):
+            return self.expand(value)
+        if isinstance(value, dict):
+            return {key: self.expand_value(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.expand_value(item) for item in value]
+        return value
+
+@functools.lru_cache(maxsize=None)
+def load_acronym_expander():
+    """
+    The AcronymExpander for acronyms_json_path, built on first use.
+    """
+    return AcronymExpander.from_json(acronyms_json_path)
+
+class HtmlRenderer:
+    """
+    Renders PONS HTML fragments (hints, translations) as the text Excel should show:
+    tilde placeholders marked, acronyms optionally expanded, tags stripped and entities unescaped.
+    Rendered fragments are kept in a bounded LRU cache keyed on the fragment string, since the
+    same examples recur across thousands of rows.
+    """
+
+    def __init__(self, expander=None, strip_html=True, tilde_marker=None, cache_size=50000):
+        self.expander = expander
+        self.strip_html = strip_html
+        self.tilde_marker = tilde_marker
+        self.render = functools.lru_cache(maxsize=cache_size)(self.render_fragment)
+
+    def render_fragment(self, fragment):
+        if "<" not in fragment and "&" not in fragment:
+            return fragment
+        if self.tilde_marker is not None:
+            fragment = TILDE_PATTERN.sub(
+                lambda match: match.group(1) + self.tilde_marker.format(match.group(2).strip()) + match.group(3),
+                fragment
+            )
+        if self.expander is not None:
+            fragment = self.expander.expand(fragment)
+        if self.strip_html:
+            fragment = " ".join(html.unescape(HTML_TAG_PATTERN.sub('', fragment)).split())
+        return fragment
+
+    def render_value(self, value):
+        """
+        Render a hint value: a fragment, or an example object whose rendered strings are joined with " — ".
+        """
+        if isinstance(value, str):
+            return self.render(value)
+        if isinstance(value, dict):
+            parts = [self.render_value(item) for item in value.values()]
+            return " — ".join(part for part in parts if isinstance(part, str) and part)
+        return value
+
+    def render_results(self, results, columns):
+        """
+        Render the given columns of a batch of result rows in place.
+        """
+        for result in results:
+            for column in columns:
+                value = result.get(column)
+                if value is not None:
+                    result[column] = self.render_value(value)
+
+@functools.lru_cache(maxsize=None)
+def load_hint_renderer():
+    """
+    The HtmlRenderer configured by the hint settings, built on first use.
+    """
+    return HtmlRenderer(
+        load_acronym_expander() if expand_hint_acronyms else None,
+        strip_html=strip_hint_html, tilde_marker=hint_tilde_marker, cache_size=hint_render_cache_size
+    )
+
+@functools.lru_cache(maxsize=None)
+def load_grid_renderer():
+    """
+    The HtmlRenderer of the translation grid: tags always stripped and none of the hint settings
+    applied, so the grid cells hold plain text whatever the hints are configured to show.
+    """
+    return HtmlRenderer(strip_html=True, cache_size=hint_render_cache_size)
+
+def iter_concatenated_entries(path, chunk_size=1 << 20, raw=False):
+    """
+    Stream the entries of a JSON array file (such as concatenated.json) one at a time,
+    decoding from a sliding buffer instead of loading the whole array.
+    With raw=True the JSON text of each entry is yielded instead of the decoded value.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as file:
+        buffer = file.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not contain a JSON array")
+        position = 1
+        end_of_file = False
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position >= len(buffer):
+                    raise json.JSONDecodeError("Buffer exhausted", buffer, position)
+                entry, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+                chunk = file.read(chunk_size)
+                end_of_file = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield buffer[position:end] if raw else entry
+            position = end
+
+def expand_acronyms_in_corpus():
+    """
+    Write concatenated.json with every acronym expanded to expanded_file_path,
+    streaming entry by entry.
+    """
+    logging.info("Starting expand_acronyms_in_corpus function.")
+    if not os.path.exists(concatenated_file_path):
+        logging.error(f"Concatenated JSON file not found at {concatenated_file_path}.")
+        return
+    expander = load_acronym_expander()
+    count = 0
+    try:
+        with open(expanded_file_path + ".tmp", 'w', encoding='utf-8') as output_file:
+            output_file.write("[\n")
+            for json_entry in iter_concatenated_entries(concatenated_file_path):
+                if count:
+                    output_file.write(",\n")
+                output_file.write(json.dumps(expander.expand_value(json_entry), ensure_ascii=False, indent=4))
+                count += 1
+            output_file.write("\n]\n")
+        os.replace(expanded_file_path + ".tmp", expanded_file_path)
+        logging.info(
+            f"Expanded {expander.expanded} acronyms in {count} entries "
+            f"({len(expander.cache)} distinct fragments, {expander.unknown} without expansion) "
+            f"into {expanded_file_path}"
+        )
+    except Exception as e:
+        logging.error(f"Exception in expand_acronyms_in_corpus: {e}", exc_info=True)
+
+def parse_path(expression):
+    """
+    Split a path expression such as "[*].data[0].hits[*].roms[*].headword_full" into
+    ("index", n) / ("key", name) steps, with None for the [*] and .* wildcards.
+    """
+    steps = []
+    position = 0
+    while position < len(expression):
+        match = PATH_STEP_PATTERN.match(expression, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Invalid path expression {expression!r} at position {position}")
+        index, key = match.groups()
+        if index is not None:
+            steps.append(("index", None if index == "*" else int(index)))
+        else:
+            steps.append(("key", None if key == "*" else key))
+        position = match.end()
+    if not steps:
+        raise ValueError("Empty path expression")
+    return tuple(steps)
+
+def compile_path_node(node):
+    """
+    Compile one node of a path trie into visit(value, path, emit), specialised for its steps.
+    emit(expression, path, value) is called for every expression ending at the node.
+    """
+    expressions = tuple(node.get(None, ()))
+    visitors = []
+    for step, child in node.items():
+        if step is None:
+            continue
+        kind, name = step
+        visit_child = compile_path_node(child)
+        if kind == "index" and name is None:
+            def visitor(value, path, emit, visit_child=visit_child):
+                if isinstance(value, list):
+                    for index, item in enumerate(value):
+                        visit_child(item, f"{path}[{index}]", emit)
+        elif kind == "index":
+            def visitor(value, path, emit, visit_child=visit_child, index=name, token=f"[{name}]"):
+                if isinstance(value, list) and index < len(value):
+                    visit_child(value[index], path + token, emit)
+        elif name is None:
+            def visitor(value, path, emit, visit_child=visit_child):
+                if isinstance(value, dict):
+                    for key, item in value.items():
+                        visit_child(item, f"{path}.{key}" if path else key, emit)
+        else:
+            def visitor(value, path, emit, visit_child=visit_child, key=name):
+                if isinstance(value, dict) and key in value:
+                    visit_child(value[key], f"{path}.{key}" if path else key, emit)
+        visitors.append(visitor)
+
+    if not visitors:
+        def visit(value, path, emit):
+            for expression in expressions:
+                emit(expression, path, value)
+    elif len(visitors) == 1 and not expressions:
+        visit = visitors[0]
+    else:
+        visitors = tuple(visitors)
+
+        def visit(value, path, emit):
+            for expression in expressions:
+                emit(expression, path, value)
+            for visitor in visitors:
+                visitor(value, path, emit)
+    return visit
+
+class PathExtractor:
+    """
+    Evaluates many path expressions in one traversal. The expressions are merged into a trie of
+    steps and every trie node is compiled once into a closure, so shared prefixes such as
+    [*].data[*].hits[*].roms[*] are walked once per document rather than once per expression.
+    """
+
+    def __init__(self, expressions):
+        self.expressions = tuple(expressions)
+        root = {}
+        for expression in self.expressions:
+            node = root
+            for step in parse_path(expression):
+                node = node.setdefault(step, {})
+            node.setdefault(None, []).append(expression)
+        self.visit = compile_path_node(root)
+        # A streamed corpus is the top-level array, so its first step selects entries by position
+        self.entry_visitors = tuple(
+            (step[1], compile_path_node(child)) for step, child in root.items() if step and step[0] == "index"
+        )
+
+    def extract(self, document):
+        """
+        List the (expression, concrete path, value) matches in one JSON document.
+        """
+        matches = []
+        self.visit(document, "", lambda expression, path, value: matches.append((expression, path, value)))
+        return matches
+
+    def extract_entries(self, entries):
+        """
+        Yield (expression, concrete path, value) over a stream of top-level array entries,
+        e.g. iter_concatenated_entries(), visiting each entry once.
+        """
+        matches = []
+        emit = lambda expression, path, value: matches.append((expression, path, value))
+        for index, entry in enumerate(entries):
+            for wanted_index, visit in self.entry_visitors:
+                if wanted_index is None or wanted_index == index:
+                    visit(entry, f"[{index}]", emit)
+            if matches:
+                yield from matches
+                matches.clear()
+
+def extract_paths_from_corpus():
+    """
+    Evaluate extract_path_expressions over concatenated.json in a single streamed pass
+    and write one CSV row per match to extracted_paths_path.
+    """
+    logging.info("Starting extract_paths_from_corpus function.")
+    if not os.path.exists(concatenated_file_path):
+        logging.error(f"Concatenated JSON file not found at {concatenated_file_path}.")
+        return
+    try:
+        extractor = PathExtractor(extract_path_expressions)
+        counts = dict.fromkeys(extractor.expressions, 0)
+        with open(extracted_paths_path + ".tmp", 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Expression", "Path", "Value"])
+            for expression, path, value in extractor.extract_entries(iter_concatenated_entries(concatenated_file_path)):
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value, ensure_ascii=False)
+                writer.writerow([expression, path, value])
+                counts[expression] += 1
+        os.replace(extracted_paths_path + ".tmp", extracted_paths_path)
+        for expression, count in counts.items():
+            logging.info(f"  {expression}: {count} values")
+        logging.info(f"Extracted {sum(counts.values())} values into {extracted_paths_path}")
+    except Exception as e:
+        logging.error(f"Exception in extract_paths_from_corpus: {e}", exc_info=True)
+
+class PathProfile:
+    """
+    Statistics of one generalized path: how often it occurs, its JSON types, how often it is null,
+    and a reservoir sample of (query, value) examples drawn from the `seen` non-null scalar values.
+    """
+    __slots__ = ("count", "nulls", "types", "seen", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.types = {}
+        self.seen = 0
+        self.samples = []
+
+class SchemaProfile:
+    """
+    Schema statistics per generalized path ("[*].data[*].hits[*].roms[*].headword_full"), built entry by
+    entry in bounded memory: a path keeps only counters and at most `sample_size` examples.
+    Profiles of disjoint shards are combined with merge().
+    """
+
+    def __init__(self, sample_size, seed=0):
+        self.sample_size = sample_size
+        self.random = random.Random(seed)
+        self.entries = 0
+        self.paths = {}
+
+    def add_entry(self, entry):
+        self.entries += 1
+        query = entry.get("query") if isinstance(entry, dict) else None
+        stack = [("[*]", entry)]
+        while stack:
+            path, value = stack.pop()
+            profile = self.paths.get(path)
+            if profile is None:
+                profile = self.paths[path] = PathProfile()
+            profile.count += 1
+            type_name = JSON_TYPE_NAMES.get(type(value), type(value).__name__)
+            profile.types[type_name] = profile.types.get(type_name, 0) + 1
+            if value is None:
+                profile.nulls += 1
+            elif isinstance(value, dict):
+                stack.extend((f"{path}.{key}", item) for key, item in value.items())
+            elif isinstance(value, list):
+                item_path = path + "[*]"
+                stack.extend((item_path, item) for item in value)
+            else:
+                # Reservoir sampling (Algorithm R) over the non-null scalar values of the path
+                profile.seen += 1
+                if len(profile.samples) < self.sample_size:
+                    profile.samples.append((query, value))
+                else:
+                    slot = self.random.randrange(profile.seen)
+                    if slot < self.sample_size:
+                        profile.samples[slot] = (query, value)
+
+    def merge(self, other):
+        """
+        Add the statistics of a profile built over a disjoint set of entries.
+        Reservoirs are combined by drawing from each side in proportion to the values it has seen.
+        """
+        self.entries += other.entries
+        for path, theirs in other.paths.items():
+            ours = self.paths.get(path)
+            if ours is None:
+                self.paths[path] = theirs
+                continue
+            ours.count += theirs.count
+            ours.nulls += theirs.nulls
+            for type_name, count in theirs.types.items():
+                ours.types[type_name] = ours.types.get(type_name, 0) + count
+            if theirs.samples:
+                ours.samples = self.merge_samples(ours.samples, ours.seen, theirs.samples, theirs.seen)
+            ours.seen += theirs.seen
+        return self
+
+    def merge_samples(self, samples, seen, other_samples, other_seen):
+        pools = [list(samples), list(other_samples)]
+        for pool in pools:
+            self.random.shuffle(pool)
+        merged = []
+        while len(merged) < self.sample_size and (pools[0] or pools[1]):
+            side = 0 if pools[0] and (not pools[1] or self.random.random() * (seen + other_seen) < seen) else 1
+            merged.append(pools[side].pop())
+        return merged
+
+    def report(self):
+        """
+        JSON-ready report: the entry count and, per path in sorted order, counts, types,
+        null rate and example values (long strings cut to SCHEMA_SAMPLE_LENGTH characters).
+        """
+        paths = {}
+        for path in sorted(self.paths):
+            profile = self.paths[path]
+            paths[path] = {
+                "count": profile.count,
+                "types": dict(sorted(profile.types.items(), key=lambda item: -item[1])),
+                "nulls": profile.nulls,
+                "null_rate": round(profile.nulls / profile.count, 6),
+                "examples": [
+                    {"query": query, "value": value[:SCHEMA_SAMPLE_LENGTH] if isinstance(value, str) else value}
+                    for query, value in profile.samples
+                ],
+            }
+        return {"entries": self.entries, "paths": paths}
+
+def iter_shards(items, size):
+    """
+    Yield consecutive lists of up to `size` items.
+    """
+    iterator = iter(items)
+    while True:
+        shard = list(itertools.islice(iterator, size))
+        if not shard:
+            return
+        yield shard
+
+def map_corpus_shards(function, *args):
+    """
+    Stream concatenated.json in shards of corpus_shard_size raw entry texts and yield
+    function(texts, first_index, *args) for every shard, computed by a pool of corpus_workers processes
+    (in this process when corpus_workers is 1). `first_index` is the corpus index of the shard's
+    first entry, counted here so workers never depend on their own copy of the settings.
+    Results arrive in completion order.
+    At most two shards per worker are in flight, so memory stays bounded for any corpus size.
+    """
+    workers = corpus_workers or os.cpu_count() or 1
+    shards = iter_shards(iter_concatenated_entries(concatenated_file_path, raw=True), corpus_shard_size)
+    first_index = 0
+    if workers == 1:
+        for texts in shards:
+            yield function(texts, first_index, *args)
+            first_index += len(texts)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for texts in shards:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(function, texts, first_index, *args))
+            first_index += len(texts)
+        for future in pending:
+            yield future.result()
+
+def profile_schema_shard(texts, first_index, sample_size):
+    """
+    Profile one shard of raw concatenated.json entries; runs in a worker process.
+    """
+    profile = SchemaProfile(sample_size, first_index + 1)
+    for text in texts:
+        profile.add_entry(json.loads(text))
+    profile.random = None
+    return profile
+
+def profile_schema():
+    """
+    Profile concatenated.json shard by shard (map_corpus_shards) and merge the partial profiles
+    into schema_profile_path.
+    """
+    logging.info("Starting profile_schema function.")
+    if not os.path.exists(concatenated_file_path):
+        logging.error(f"Concatenated JSON file not found at {concatenated_file_path}.")
+        return
+    workers = corpus_workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    try:
+        profile = SchemaProfile(schema_sample_size)
+        for shard_profile in map_corpus_shards(profile_schema_shard, schema_sample_size):
+            profile.merge(shard_profile)
+        write_json_atomic(schema_profile_path, profile.report(), indent=4)
+        logging.info(
+            f"Profiled {profile.entries} entries ({len(profile.paths)} paths) with {workers} worker(s) "
+            f"in {time.perf_counter() - started:.2f}s; report saved to {schema_profile_path}"
+        )
+    except Exception as e:
+        logging.error(f"Exception in profile_schema: {e}", exc_info=True)
+
+def markup_is_balanced(fragment):
+    """
+    True if every tag of an HTML fragment is closed in order and no bare "<" is left in the text.
+    """
+    if "<" not in fragment:
+        return True
+    open_tags = []
+    tags = 0
+    for match in MARKUP_TAG_PATTERN.finditer(fragment):
+        tags += 1
+        closing, tag, _, self_closing = match.groups()
+        tag = tag.lower()
+        if self_closing or tag in VOID_TAGS:
+            continue
+        if not closing:
+            open_tags.append(tag)
+        elif not open_tags or open_tags.pop() != tag:
+            return False
+    return not open_tags and fragment.count("<") == tags
+
+def validate_entry(json_entry):
+    """
+    Classify one stored response as one of VALIDATION_CATEGORIES.
+    Returns (category, detail), where detail names the error or the first offending field.
+    """
+    data = json_entry.get("data")
+    if isinstance(data, dict) and "error" in data:
+        error = str(data["error"])
+        if error.startswith("Exception"):
+            return "exception", error
+        if error == "Received status code 204":
+            return "not_found_204", error
+        return "http_error", error
+    blocks = data if isinstance(data, list) else [data] if isinstance(data, dict) else []
+    hits = [hit for block in blocks if isinstance(block, dict) for hit in block.get("hits") or []]
+    if not hits:
+        return "empty_hits", None
+    roms = list(extract_roms(data))
+    if not roms:
+        return "hits_without_roms", f"{len(hits)} hits"
+    missing_wordclass = None
+    for rom_index, rom in enumerate(roms):
+        fragments = [("headword_full", rom.get("headword_full")), ("header", rom.get("header"))]
+        for arab_index, arab in enumerate(rom.get("arabs") or []):
+            fragments.append((f"arabs[{arab_index}].header", arab.get("header")))
+            for translation_index, translation in enumerate(arab.get("translations") or []):
+                for side in ("source", "target"):
+                    fragments.append((f"arabs[{arab_index}].translations[{translation_index}].{side}", translation.get(side)))
+        for field, fragment in fragments:
+            if isinstance(fragment, str) and not markup_is_balanced(fragment):
+                return "malformed_span", f"roms[{rom_index}].{field}"
+        if missing_wordclass is None and not rom.get("wordclass") and 'class="wordclass"' not in (rom.get("headword_full") or ""):
+            missing_wordclass = f"roms[{rom_index}] {extract_headword(rom)}"
+    if missing_wordclass:
+        return "rom_without_wordclass", missing_wordclass
+    return "ok", None
+
+def validate_shard(texts, first_index):
+    """
+    Validate one shard of raw concatenated.json entries, the first of which is entry `first_index`;
+    runs in a worker process.
+    Returns the category counts and (entry index, query, category, detail) of every entry that is not ok.
+    """
+    counts = dict.fromkeys(VALIDATION_CATEGORIES, 0)
+    problems = []
+    for offset, text in enumerate(texts):
+        try:
+            json_entry = json.loads(text)
+            query = json_entry.get("query")
+            category, detail = validate_entry(json_entry)
+        except Exception as e:
+            query, category, detail = None, "exception", f"Unreadable entry: {e}"
+        counts[category] += 1
+        if category != "ok":
+            problems.append((first_index + offset, query, category, detail))
+    return counts, problems
+
+def validate_corpus():
+    """
+    Classify every entry of concatenated.json in parallel (map_corpus_shards), log the counts,
+    save the offending queries per category to validation_report_path and write the queries of
+    refetch_categories to refetch_list_path, one per line, for fetch_refetch_list.
+    Returns the report, or None if the corpus could not be validated.
+    """
+    logging.info("Starting validate_corpus function.")
+    if not os.path.exists(concatenated_file_path):
+        logging.error(f"Concatenated JSON file not found at {concatenated_file_path}.")
+        return None
+    started = time.perf_counter()
+    try:
+        counts = dict.fromkeys(VALIDATION_CATEGORIES, 0)
+        problems = []
+        for shard_counts, shard_problems in map_corpus_shards(validate_shard):
+            for category, count in shard_counts.items():
+                counts[category] += count
+            problems.extend(shard_problems)
+        problems.sort(key=lambda problem: problem[0])
+
+        offending = {category: [] for category in VALIDATION_CATEGORIES if category != "ok"}
+        for entry_index, query, category, detail in problems:
+            offending[category].append({"index": entry_index, "query": query, "detail": detail})
+        refetch = list(dict.fromkeys(
+            query for _, query, category, _ in problems if category in refetch_categories and query
+        ))
+        report = {"entries": sum(counts.values()), "counts": counts, "refetch": refetch, "offending": offending}
+        write_json_atomic(validation_report_path, report, indent=4)
+        with open(refetch_list_path + ".tmp", 'w', encoding='utf-8') as file:
+            file.writelines(f"{query}\n" for query in refetch)
+        os.replace(refetch_list_path + ".tmp", refetch_list_path)
+
+        logging.info(f"Validated {report['entries']} entries in {time.perf_counter() - started:.2f}s:")
+        for category, count in counts.items():
+            if count:
+                logging.info(f"  {category}: {count}")
+        for category, entries in offending.items():
+            for entry in entries[:10]:
+                logging.info(f"  {category}: [{entry['index']}] {entry['query']} ({entry['detail']})")
+            if len(entries) > 10:
+                logging.info(f"  {category}: ... {len(entries) - 10} more in {validation_report_path}")
+        logging.info(f"{len(refetch)} queries to refetch written to {refetch_list_path}")
+        return report
+    except Exception as e:
+        logging.error(f"Exception in validate_corpus: {e}", exc_info=True)
+        return None
+
+def flexion_items(flexion):
+    """
+    Yield (countable, item) for the comma-separated items of a flexion span such as
+    "<-ът, -и, countable -а>"; countable marks the count form used after numerals.
+    """
+    for item in (flexion or "").strip().strip("<>").split(","):
+        countable, item = False, item.strip()
+        if item.startswith("countable "):
+            countable, item = True, item[len("countable "):].strip()
+        if item:
+            yield countable, item
+
+def merge_ending(stem, ending):
+    """
+    Attach an ending to a headword without a "|" stem mark (both without stress marks).
+    An ending opening with two consonants restates the stem's last consonants around a fleeting
+    vowel and replaces them: добър + бра -> добра. Such an ending that does not restate the stem
+    cannot be placed and gives None. Any other ending is appended, a consonant it shares with the
+    stem included (радост + та -> радостта, бедуин + ът -> бедуинът).
+    """
+    if len(ending) < 2 or ending[0] in BULGARIAN_VOWELS or ending[1] in BULGARIAN_VOWELS:
+        return stem + ending
+    if len(stem) >= 3 and stem[-3] == ending[0] and stem[-2] in FLEETING_VOWELS and stem[-1] == ending[1]:
+        return stem[:-3] + ending
+    return None
+
+def attach_ending(headword_form, item):
+    """
+    Surface form of one flexion item without stress marks: an "-ending" replaces what follows
+    the "|" of the headword (or is merged onto it when there is none, see merge_ending); anything
+    else is already a full form.
+    Returns None for items that are not a single word or whose ending does not fit the headword.
+    """
+    item = item.strip().strip("()").strip()
+    if item.startswith("-"):
+        if "|" in headword_form:
+            item = headword_form.split("|", 1)[0] + item[1:]
+        else:
+            item = merge_ending(strip_stress(headword_form), strip_stress(item[1:]))
+    if not item or " " in item:
+        return None
+    return strip_stress(item)
+
+def noun_forms(headword_form, genus, flexion):
+    """
+    Noun form columns of a headword (with its "|" stem mark), its genus and its flexion,
+    e.g. бедуѝн, masculine, "<-ът, -и>" -> бедуинът, бедуина, бедуини, бедуините.
+    Definite forms the flexion leaves out are derived: -та for feminine, -то for neuter nouns,
+    the short masculine article from the long one and the plural article from the plural.
+    """
+    # "masculine and feminine" nouns take the masculine article
+    genus = (genus or "").split(" ")[0]
+    forms = {}
+    for countable, item in flexion_items(flexion):
+        form = attach_ending(headword_form, item)
+        if not form:
+            continue
+        if countable:
+            forms.setdefault("Noun Numeral Plural", form)
+        elif (genus == "masculine" and form.endswith(("ът", "ят"))
+              or genus == "feminine" and form.endswith("та")
+              or genus == "neuter" and form.endswith("то")):
+            forms.setdefault("Noun Long Definite", form)
+        elif form.endswith("те") and "Noun Plural" in forms:
+            forms.setdefault("Noun Plural Definite", form)
+        else:
+            forms.setdefault("Noun Plural", form)
+
+    lemma = strip_stress(headword_form)
+    if "Noun Long Definite" not in forms and lemma:
+        if genus == "feminine":
+            forms["Noun Long Definite"] = lemma + "та"
+        elif genus == "neuter":
+            forms["Noun Long Definite"] = lemma + "то"
+    long_definite = forms.get("Noun Long Definite", "")
+    if genus == "masculine" and long_definite.endswith(("ът", "ят")):
+        forms["Noun Short Definite"] = long_definite[:-2] + ("а" if long_definite.endswith("ът") else "я")
+    plural = forms.get("Noun Plural", "")
+    if plural and "Noun Plural Definite" not in forms:
+        if plural.endswith(("и", "е")):
+            forms["Noun Plural Definite"] = plural + "те"
+        elif plural.endswith(("а", "я")):
+            forms["Noun Plural Definite"] = plural + "та"
+    return forms
+
+def adjective_forms(headword_form, flexion, feminine, neuter):
+    """
+    Adjective form columns: the headword is the masculine form, the feminine and neuter endings
+    come from the feminine and maskuline spans (PONS marks the neuter ending "maskuline") and the
+    flexion holds the plural, e.g. вла̀кнест (-а) <-и> -о. A flexion without those spans lists
+    feminine, neuter and plural in that order.
+    """
+    items = [item for _, item in flexion_items(flexion)]
+    if feminine is None and neuter is None and len(items) == 3:
+        feminine, neuter = items[0], items[1]
+    forms = {
+        "Adjective Masculine": strip_stress(headword_form),
+        "Adjective Feminine": attach_ending(headword_form, feminine) if feminine else None,
+        "Adjective Neuter": attach_ending(headword_form, neuter) if neuter else None,
+        "Adjective Plural": attach_ending(headword_form, items[-1]) if items else None,
+    }
+    return {column: form for column, form in forms.items() if form}
+
+def rom_inflections(rom):
+    """
+    Yield (lemma, wordclass, ((column, form), ...)) for the noun or adjective headwords of a rom.
+    The rom's own headword takes the first flexion and genus; further <span class="headword">
+    lemmas (e.g. a feminine equivalent) take the following ones when each lemma has its own.
+    """
+    attributes = rom.attributes
+    headword_form = html.unescape(rom.headword_full.split("<", 1)[0]).strip() or rom.headword
+    lemmas = [headword_form] + list(attributes.get("headword", ()))
+    flexions = attributes.get("flexion", ())
+    genera = attributes.get("genus", ())
+    wordclasses = attributes.get("wordclass", ())
+    if not (len(lemmas) > 1 and len(flexions) == len(genera) == len(wordclasses) == len(lemmas)):
+        lemmas, flexions, genera, wordclasses = lemmas[:1], flexions[:1], genera[:1], wordclasses[:1]
+    for index, lemma in enumerate(lemmas):
+        wordclass = wordclasses[index] if index < len(wordclasses) else None
+        flexion = flexions[index] if index < len(flexions) else None
+        if wordclass == "noun":
+            forms = noun_forms(lemma, genera[index] if index < len(genera) else None, flexion)
+        elif wordclass == "adjective":
+            forms = adjective_forms(
+                lemma, flexion,
+                next(iter(attributes.get("feminine", ())), None), next(iter(attributes.get("maskuline", ())), None)
+            )
+        else:
+            continue
+        if forms:
+            yield strip_stress(lemma), wordclass, tuple(forms.items())
+
+class EntryRecord:
+    """
+    Compiled, matcher-ready view of one concatenated.json entry.
+    Built once at load by compile_entry(); the matcher never touches the raw response again.
+    """
+    __slots__ = (
+        "index", "query", "key", "headwords", "wordclasses", "partials", "aspect_pairs", "inflections",
+        "hints", "translations", "grid", "error"
+    )
+
+    def __init__(self, index, query, key, headwords, wordclasses, partials, aspect_pairs, inflections,
+                 hints, translations, error):
+        self.index = index
+        self.query = query
+        self.key = key
+        self.headwords = headwords
+        self.wordclasses = wordclasses
+        self.partials = partials
+        self.aspect_pairs = aspect_pairs
+        self.inflections = inflections
+        self.hints = hints
+        self.translations = translations
+        self.grid = None
+        self.error = error
+
+    @property
+    def translation_grid(self):
+        """
+        {TRANSLATION_GRID_COLUMNS column: rendered targets joined with "; "}, built the first time
+        the entry is matched and cached, so every further card matching it is a lookup.
+        """
+        if self.grid is None:
+            renderer = load_grid_renderer()
+            grid = dict.fromkeys(TRANSLATION_GRID_COLUMNS)
+            for column, targets in self.translations:
+                grid[column] = "; ".join(text for text in map(renderer.render, targets) if text) or None
+            self.grid = grid
+        return self.grid
+
+def compile_entry(index, parsed_entry):
+    """
+    Reduce one parsed entry to what matching needs:
+    normalized query, (key, raw) headwords, wordclasses, (key, level, raw) partial-match keys,
+    (headword, aspect, ((partner, aspect), ...)) verb aspects, (lemma, wordclass, ((column, form), ...))
+    noun and adjective forms, the raw first HINT_COUNT hints padded with None (rendered before output),
+    (grid column, raw targets) per rom and arab of TRANSLATION_GRID_LAYOUT and the error message of failed fetches.
+    """
+    headwords = []
+    wordclasses = set()
+    partials = []
+    aspect_pairs = []
+    inflections = []
+    hints = []
+    translations = []
+    for rom_number, rom in enumerate(parsed_entry.roms):
+        headword_key = normalize_key(rom.headword)
+        if headword_key:
+            headwords.append((headword_key, rom.headword))
+        wordclasses.add(rom.wordclass)
+        for element_class, level in PARTIAL_MATCH_CLASSES:
+            value = next(rom.iter_attribute(element_class), None)
+            if value:
+                partials.append((normalize_key(value), level, value))
+        # The rom's own aspect comes first, then one conjugation span per partner headword
+        aspects = [ASPECTS.get(value) for value in rom.attributes.get("conjugation", ())]
+        if aspects and aspects[0]:
+            partners = tuple(
+                (strip_stress(partner), partner_aspect)
+                for partner, partner_aspect in zip(rom.attributes.get("headword", ()), aspects[1:])
+                if partner_aspect
+            )
+            aspect_pairs.append((strip_stress(rom.headword), aspects[0], partners))
+        inflections.extend(rom_inflections(rom))
+        hints.extend(rom.examples[:HINT_COUNT - len(hints)])
+        if rom_number < len(TRANSLATION_GRID_LAYOUT):
+            roman, arab_count = TRANSLATION_GRID_LAYOUT[rom_number]
+            for arab_number, arab in enumerate(rom.arabs[:arab_count], 1):
+                targets = tuple(translation.target for translation in arab.translations if translation.target)
+                if targets:
+                    translations.append((f"PONS en {roman}.{arab_number}", targets))
+    hints.extend([None] * (HINT_COUNT - len(hints)))
+
+    query = parsed_entry.query
+    return EntryRecord(
+        index, query, normalize_key(query), tuple(headwords), frozenset(wordclasses),
+        tuple(partials), tuple(aspect_pairs), tuple(inflections), tuple(hints),
+        tuple(translations), parsed_entry.error
+    )
+
+def compile_entries(parsed_corpus):
+    """
+    Compile every parsed entry into an EntryRecord.
+    """
+    records = [compile_entry(index, parsed_entry) for index, parsed_entry in enumerate(parsed_corpus)]
+    logging.info(f"Compiled {len(records)} entry records.")
+    return records
+
+def compile_selected_entries(concatenated_data, queries):
+    """
+    Parse and compile only the entries whose query is in `queries`, keeping their corpus index.
+    """
+    parser = MarkupParser(load_markup_catalogue(markup_catalogue_path))
+    records = [
+        compile_entry(index, parse_entry(json_entry, parser))
+        for index, json_entry in enumerate(concatenated_data)
+        if json_entry.get("query") in queries
+    ]
+    logging.info(f"Compiled {len(records)} changed entry records.")
+    return records
+
+def record_keys(record):
+    """
+    Yield (normalized key, raw value, is_query) for the query and every rom headword of a record.
+    """
+    if record.key:
+        yield record.key, record.query, True
+    for headword_key, headword in record.headwords:
+        yield headword_key, headword, False
+
+def record_index_keys(record):
+    """
+    Every normalized key a record is indexed under: query and headwords (exact, cutoff and fuzzy levels),
+    partial-match spans, aspect partners and inflected forms. Rows whose terms hit one of these keys
+    must be re-matched when the record is new or changed.
+    """
+    return itertools.chain(
+        (key for key, _, _ in record_keys(record)),
+        (key for key, _, _ in record.partials),
+        record_aspect_keys(record),
+        record_inflection_keys(record)
+    )
+
+class MatchIndex:
+    """
+    Lookup structures over the compiled records, built once per run.
+    keys: normalized key -> [(record, raw value)], query matches before headword matches.
+    partials: normalized key -> (record, level, raw value) of the first partial-match span.
+    fuzzy: BK-tree over all normalized keys, built on first use.
+    aspects: verb aspect pairs (AspectIndex).
+    inflections: noun and adjective forms (InflectionIndex).
+    """
+    __slots__ = ("records", "keys", "partials", "_fuzzy", "aspects", "inflections")
+
+    def __init__(self, records):
+        self.records = records
+        self.keys = build_key_index(records)
+        self.partials = build_partial_index(records)
+        self._fuzzy = None
+        self.aspects = AspectIndex(records)
+        self.inflections = InflectionIndex(records)
+
+    @property
+    def fuzzy(self):
+        """
+        The BK-tree is only needed by FuzzyStrategy, which runs for rows no earlier level
+        matched, so it is built when that strategy first searches it and never when "fuzzy"
+        is left out of match_strategy_order.
+        """
+        if self._fuzzy is None:
+            self._fuzzy = build_fuzzy_index(self.records)
+        return self._fuzzy
+
+class AspectIndex:
+    """
+    Bidirectional index of verb aspect pairs, built from the conjugation spans of every rom.
+    aspects: normalized headword -> "imperfective" / "perfective"
+    partners: normalized headword -> normalized headwords of its aspect partners
+    forms: normalized headword -> display form (stress marks removed)
+    A rom lists its own aspect first and then each partner (<span class="headword">) followed
+    by the partner's aspect; partners found in any entry are linked in both directions.
+    """
+    __slots__ = ("aspects", "partners", "forms")
+
+    def __init__(self, records):
+        self.aspects = {}
+        self.partners = {}
+        self.forms = {}
+        for record in records:
+            for headword, aspect, pairs in record.aspect_pairs:
+                key = self.add(headword, aspect)
+                for partner, partner_aspect in pairs:
+                    partner_key = self.add(partner, partner_aspect)
+                    if partner_key != key:
+                        self.partners.setdefault(key, set()).add(partner_key)
+                        self.partners.setdefault(partner_key, set()).add(key)
+        logging.info(f"Built aspect index with {len(self.aspects)} verbs and "
+                     f"{sum(len(keys) for keys in self.partners.values()) // 2} aspect pairs.")
+
+    def add(self, form, aspect):
+        key = normalize_key(form)
+        self.forms.setdefault(key, form)
+        if aspect:
+            self.aspects.setdefault(key, aspect)
+        return key
+
+    def lookup(self, key):
+        """
+        {aspect: display form} for a verb and its partners, or None if the key is unknown.
+        The first partner (in form order) of each aspect is used.
+        """
+        if key not in self.aspects and key not in self.partners:
+            return None
+        aspect = self.aspects.get(key)
+        forms = {aspect: self.forms[key]} if aspect else {}
+        for partner_key in sorted(self.partners.get(key, ()), key=self.forms.get):
+            partner_aspect = self.aspects.get(partner_key)
+            if partner_aspect and partner_aspect not in forms:
+                forms[partner_aspect] = self.forms[partner_key]
+        return {"aspect": aspect, **forms}
+
+def record_aspect_keys(record):
+    """
+    Normalized headwords of every verb and aspect partner listed by a record.
+    """
+    for headword, _, pairs in record.aspect_pairs:
+        yield normalize_key(headword)
+        for partner, _ in pairs:
+            yield normalize_key(partner)
+
+class InflectionIndex:
+    """
+    Form -> lemma index over the noun and adjective forms generated from flexion spans.
+    forms: normalized inflected form -> [(record, lemma, wordclass, column)] in corpus order
+    lemmas: normalized lemma -> {column: form}, the first form generated for each column
+    Forms equal to their lemma (e.g. Adjective Masculine) are left to the exact levels.
+    """
+    __slots__ = ("forms", "lemmas")
+
+    def __init__(self, records):
+        self.forms = {}
+        self.lemmas = {}
+        for record in records:
+            for lemma, wordclass, forms in record.inflections:
+                lemma_key = normalize_key(lemma)
+                columns = self.lemmas.setdefault(lemma_key, {})
+                for column, form in forms:
+                    columns.setdefault(column, form)
+                    form_key = normalize_key(form)
+                    if form_key == lemma_key:
+                        continue
+                    candidates = self.forms.setdefault(form_key, [])
+                    if not candidates or candidates[-1][:2] != (record, lemma):
+                        candidates.append((record, lemma, wordclass, column))
+        logging.info(f"Built inflection index with {len(self.forms)} forms of {len(self.lemmas)} lemmas.")
+
+    def columns(self, key):
+        """
+        All INFLECTION_COLUMNS of a lemma, or None if no forms were generated for it.
+        """
+        forms = self.lemmas.get(key)
+        if not forms:
+            return None
+        return {column: forms.get(column) for column in INFLECTION_COLUMNS}
+
+def record_inflection_keys(record):
+    """
+    Normalized lemmas and generated forms of every noun and adjective of a record.
+    """
+    for lemma, _, forms in record.inflections:
+        yield normalize_key(lemma)
+        for _, form in forms:
+            yield normalize_key(form)
+
+def facet_value(value):
+    """
+    Case- and whitespace-insensitive form of a facet value ("VERB" and "verb" are one value).
+    """
+    return " ".join(str(value).casefold().split())
+
+def bitmap_from_ids(rom_ids, size):
+    """
+    Python int with bit n set for every n in rom_ids, built through a bytearray in linear time.
+    """
+    bits = bytearray((size + 7) // 8)
+    for rom_id in rom_ids:
+        bits[rom_id >> 3] |= 1 << (rom_id & 7)
+    return int.from_bytes(bits, "little")
+
+def bitmap_ids(bitmap):
+    """
+    Yield the set bits of a bitmap in ascending order.
+    """
+    for byte_index, byte in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")):
+        while byte:
+            low_bit = byte & -byte
+            yield (byte_index << 3) + low_bit.bit_length() - 1
+            byte ^= low_bit
+
+class FacetIndex:
+    """
+    Faceted index over every rom of the parsed corpus: for each facet in FACET_CLASSES, value -> bitmap
+    of rom ids stored as a Python int (bit n set when rom n carries the value). A rom carries the values
+    of its headword_full and of its headers and sources. Combined queries are a few bitwise AND/OR
+    operations on these ints, with no HTML rescanned.
+    roms: rom id -> (entry index, rom index)
+    """
+
+    def __init__(self, parsed_corpus):
+        self.roms = []
+        rom_ids = {facet: {} for facet in FACET_CLASSES}
+        for entry_index, parsed_entry in enumerate(parsed_corpus):
+            for rom_index, rom in enumerate(parsed_entry.roms):
+                rom_id = len(self.roms)
+                self.roms.append((entry_index, rom_index))
+                for facet in FACET_CLASSES:
+                    values = itertools.chain(rom.attributes.get(facet, ()), rom.iter_attribute(facet))
+                    for value in {facet_value(value) for value in values}:
+                        rom_ids[facet].setdefault(value, []).append(rom_id)
+        self.all = (1 << len(self.roms)) - 1
+        self.facets = {
+            facet: {value: bitmap_from_ids(ids, len(self.roms)) for value, ids in values.items()}
+            for facet, values in rom_ids.items()
+        }
+        self.present = {}
+        logging.info(
+            f"Built facet index over {len(self.roms)} roms: "
+            + ", ".join(f"{facet} {len(values)} values" for facet, values in self.facets.items())
+        )
+
+    def with_facet(self, facet):
+        """
+        Bitmap of the roms carrying any value of a facet, computed on first use.
+        """
+        bitmap = self.present.get(facet)
+        if bitmap is None:
+            bitmap = 0
+            for value_bitmap in self.facets[facet].values():
+                bitmap |= value_bitmap
+            self.present[facet] = bitmap
+        return bitmap
+
+    def select(self, criteria):
+        """
+        Bitmap of the roms matching every {facet: wanted} criterion, where wanted is a value,
+        a list of values (any of them), "!value" to exclude a value, or None for roms without the facet.
+        """
+        bitmap = self.all
+        for facet, wanted in criteria.items():
+            if facet not in self.facets:
+                raise ValueError(f"Unknown facet {facet!r}; facets are {', '.join(FACET_CLASSES)}")
+            if wanted is None:
+                bitmap &= self.all ^ self.with_facet(facet)
+                continue
+            included = None
+            for value in wanted if isinstance(wanted, list) else [wanted]:
+                if value.startswith("!"):
+                    bitmap &= self.all ^ self.facets[facet].get(facet_value(value[1:]), 0)
+                else:
+                    included = (included or 0) | self.facets[facet].get(facet_value(value), 0)
+            if included is not None:
+                bitmap &= included
+        return bitmap
+
+    def count(self, bitmap):
+        return bin(bitmap).count("1")
+
+    def iter_roms(self, bitmap):
+        """
+        Yield the (entry index, rom index) of every rom in a bitmap, in corpus order.
+        """
+        for rom_id in bitmap_ids(bitmap):
+            yield self.roms[rom_id]
+
+def query_facets():
+    """
+    Build the FacetIndex over the parsed corpus, run every query of facet_queries and write
+    the matching roms (query name, entry query, headword, wordclass) to facet_results_path.
+    """
+    logging.info("Starting query_facets function.")
+    if not os.path.exists(concatenated_file_path):
+        logging.error(f"Concatenated JSON file not found at {concatenated_file_path}.")
+        return
+    try:
+        with open(concatenated_file_path, 'r', encoding='utf-8') as file:
+            concatenated_data = json.load(file)
+        parsed_corpus = load_parsed_corpus(concatenated_data)
+        del concatenated_data
+        started = time.perf_counter()
+        facet_index = FacetIndex(parsed_corpus)
+        logging.info(f"Facet index built in {time.perf_counter() - started:.3f}s.")
+
+        with open(facet_results_path + ".tmp", 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Facet Query", "Query", "Headword", "Wordclass"])
+            for name, criteria in facet_queries.items():
+                started = time.perf_counter()
+                bitmap = facet_index.select(criteria)
+                elapsed = time.perf_counter() - started
+                entries = set()
+                for entry_index, rom_index in facet_index.iter_roms(bitmap):
+                    parsed_entry = parsed_corpus[entry_index]
+                    rom = parsed_entry.roms[rom_index]
+                    entries.add(entry_index)
+                    writer.writerow([name, parsed_entry.query, rom.headword, rom.wordclass])
+                logging.info(f"  {name}: {facet_index.count(bitmap)} roms in {len(entries)} entries "
+                             f"(selected in {elapsed * 1e6:.0f} µs)")
+        os.replace(facet_results_path + ".tmp", facet_results_path)
+        logging.info(f"Facet query results saved to {facet_results_path}")
+    except Exception as e:
+        logging.error(f"Exception in query_facets: {e}", exc_info=True)
+
+def build_key_index(records):
+    """
+    Map each normalized key to the (record, raw value) pairs carrying it.
+    Query matches come before headword matches, each in corpus order.
+    """
+    query_matches = {}
+    headword_matches = {}
+    for record in records:
+        for key, raw_value, is_query in record_keys(record):
+            candidates = (query_matches if is_query else headword_matches).setdefault(key, [])
+            if not candidates or candidates[-1][0] is not record:
+                candidates.append((record, raw_value))
+    key_index = query_matches
+    for key, candidates in headword_matches.items():
+        known = {record.index for record, _ in key_index.get(key, [])}
+        key_index.setdefault(key, []).extend(
+            candidate for candidate in candidates if candidate[0].index not in known
+        )
+    logging.info(f"Built key index with {len(key_index)} normalized keys from {len(records)} entries.")
+    return key_index
+
+def build_partial_index(records):
+    """
+    Map each normalized partial-match span to the first (record, level, raw value) carrying it.
+    """
+    partial_index = {}
+    for record in records:
+        for key, level, raw_value in record.partials:
+            if key:
+                partial_index.setdefault(key, (record, level, raw_value))
+    logging.info(f"Built partial index with {len(partial_index)} keys.")
+    return partial_index
+
+def build_fuzzy_index(records):
+    """
+    Build a BK-tree over the normalized key of every stored query and rom headword.
+    Payloads are (entry index, raw value) pairs, so the first entry per key wins on ties.
+    """
+    tree = BKTree()
+    for record in records:
+        for key, raw_value, _ in record_keys(record):
+            tree.add(key, (record.index, raw_value))
+    logging.info(f"Built fuzzy index with {tree.size} distinct keys from {len(records)} entries.")
+    return tree
+
+def make_outcome(level, record, raw_value, matched_key, pons_status, match_detail,
+                 cutoff_applied=None, fuzzy_distance=None):
+    """
+    Build the (per-field result columns, PONS status, matched record) outcome of a strategy hit.
+    """
+    hint_1, hint_2 = record.hints
+    fields = {
+        "Match Level": level,
+        "Matched Value": raw_value,
+        "Matched Key": matched_key,
+        "Cutoff Applied": cutoff_applied,
+        "Fuzzy Distance": fuzzy_distance,
+        "Hint 1": hint_1,
+        "Hint 2": hint_2,
+        "Match Detail": match_detail
+    }
+    return fields, pons_status, record
+
+NO_MATCH_OUTCOME = (RESULT_FIELD_COLUMNS_DEFAULTS, "Unmatched", None)
+
+class MatchStrategy:
+    """
+    One level of the match cascade. Subclasses define match(term, key, part_of_speech, index),
+    which returns an outcome from make_outcome() or None and adds the number of index candidates
+    it examined to self.candidates.
+    MatchPipeline keeps the hit, call and timing counters.
+    """
+    name = ""
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.candidates = 0
+        self.seconds = 0.0
+
+class ExactWordclassStrategy(MatchStrategy):
+    """
+    Level 1: exact match on the normalized key with matching wordclass.
+    """
+    name = "exact_wordclass"
+
+    def match(self, term, key, part_of_speech, index):
+        for record, raw_value in index.keys.get(key, ()) if key else ():
+            self.candidates += 1
+            if part_of_speech in record.wordclasses:
+                return make_outcome("1", record, raw_value, key, "Exact Match", "Wordclass Match")
+        return None
+
+class ExactStrategy(MatchStrategy):
+    """
+    Level 2: exact match on the normalized key regardless of wordclass.
+    """
+    name = "exact"
+
+    def match(self, term, key, part_of_speech, index):
+        candidates = index.keys.get(key) if key else None
+        if not candidates:
+            return None
+        self.candidates += 1
+        record, raw_value = candidates[0]
+        return make_outcome("2", record, raw_value, key, "Exact Match", "No Wordclass Match")
+
+class PartialStrategy(MatchStrategy):
+    """
+    Level 3: match on indirect references, collocations or reflections (levels 3b-3e).
+    """
+    name = "partial"
+
+    def match(self, term, key, part_of_speech, index):
+        partial = index.partials.get(key) if key else None
+        if partial is None:
+            return None
+        self.candidates += 1
+        record, level, raw_value = partial
+        return make_outcome(level, record, raw_value, key, "Partial Match", f"Level {level}")
+
+class CutoffWordclassStrategy(MatchStrategy):
+    """
+    Level 4: Level 1 again after cutting off a trailing particle.
+    """
+    name = "cutoff_wordclass"
+
+    def match(self, term, key, part_of_speech, index):
+        cutoff, revised_query = apply_cutoff_logic(term)
+        revised_key = normalize_key(revised_query)
+        if not cutoff or not revised_key:
+            return None
+        for record, raw_value in index.keys.get(revised_key, ()):
+            self.candidates += 1
+            if part_of_speech in record.wordclasses:
+                return make_outcome("4", record, raw_value, revised_key, "Cutoff Match",
+                                    f"Wordclass Match (cutoff: {cutoff})", cutoff_applied=cutoff)
+        return None
+
+class CutoffStrategy(MatchStrategy):
+    """
+    Level 4: Level 2 again after cutting off a trailing particle.
+    """
+    name = "cutoff"
+
+    def match(self, term, key, part_of_speech, index):
+        cutoff, revised_query = apply_cutoff_logic(term)
+        revised_key = normalize_key(revised_query)
+        candidates = index.keys.get(revised_key) if cutoff and revised_key else None
+        if not candidates:
+            return None
+        self.candidates += 1
+        record, raw_value = candidates[0]
+        return make_outcome("4", record, raw_value, revised_key, "Cutoff Match",
+                            f"No Wordclass Match (cutoff: {cutoff})", cutoff_applied=cutoff)
+
+class InflectedStrategy(MatchStrategy):
+    """
+    Level 4b: the flashcard is an inflected form (plural, definite, feminine, ...) of a noun or
+    adjective headword, looked up in the form -> lemma index. A lemma with the flashcard's wordclass is preferred.
+    """
+    name = "inflected"
+
+    def match(self, term, key, part_of_speech, index):
+        candidates = index.inflections.forms.get(key) if key else None
+        if not candidates:
+            return None
+        self.candidates += len(candidates)
+        record, lemma, _, column = next(
+            (candidate for candidate in candidates if candidate[2] == part_of_speech), candidates[0]
+        )
+        return make_outcome("4b", record, lemma, normalize_key(lemma), "Inflected Match", f"{column} of {lemma}")
+
+class FuzzyStrategy(MatchStrategy):
+    """
+    Level 5: closest query or headword within fuzzy_max_distance edits, searched in the BK-tree.
+    Among equally close candidates an entry with the flashcard's wordclass is preferred.
+    """
+    name = "fuzzy"
+
+    def match(self, term, key, part_of_speech, index):
+        if not key:
+            return None
+        candidates = index.fuzzy.search(key, fuzzy_max_distance)
+        self.candidates += index.fuzzy.last_visited
+        if not candidates:
+            return None
+        distance = candidates[0][0]
+        chosen = None
+        for candidate_distance, candidate_key, payloads in candidates:
+            if candidate_distance != distance:
+                break
+            for entry_index, raw_value in sorted(payloads):
+                record = index.records[entry_index]
+                if chosen is None or (part_of_speech in record.wordclasses
+                                      and part_of_speech not in chosen[0].wordclasses):
+                    chosen = (record, raw_value, candidate_key)
+        record, raw_value, matched_key = chosen
+        return make_outcome("5", record, raw_value, matched_key, "Fuzzy Match",
+                            f"Edit distance {distance}", fuzzy_distance=distance)
+
+# Strategies available to match_strategy_order, by name
+MATCH_STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (
+        ExactWordclassStrategy, ExactStrategy, PartialStrategy,
+        CutoffWordclassStrategy, CutoffStrategy, InflectedStrategy, FuzzyStrategy
+    )
+}
+
+class MatchPipeline:
+    """
+    Ordered match strategies sharing one MatchIndex; the first strategy that matches wins.
+    Records per strategy how often it ran and hit, the candidates it examined and the time it took.
+    """
+
+    def __init__(self, index, strategy_names):
+        self.index = index
+        self.strategies = [MATCH_STRATEGIES[name]() for name in strategy_names]
+        self.terms = 0
+        self.unmatched = 0
+
+    def match(self, term, key, part_of_speech):
+        self.terms += 1
+        for strategy in self.strategies:
+            started = time.perf_counter()
+            outcome = strategy.match(term, key, part_of_speech, self.index)
+            strategy.seconds += time.perf_counter() - started
+            strategy.calls += 1
+            if outcome is not None:
+                strategy.hits += 1
+                return outcome
+        self.unmatched += 1
+        return NO_MATCH_OUTCOME
+
+    def log_summary(self):
+        """
+        Log where matching time went, one line per strategy in pipeline order.
+        """
+        total_seconds = sum(strategy.seconds for strategy in self.strategies)
+        logging.info(f"Match pipeline: {self.terms} distinct terms matched in {total_seconds:.3f}s; {self.unmatched} unmatched.")
+        for strategy in self.strategies:
+            share = strategy.seconds / total_seconds * 100 if total_seconds else 0.0
+            logging.info(
+                f"  {strategy.name}: {strategy.hits} hits / {strategy.calls} calls, "
+                f"{strategy.candidates} candidates examined, {strategy.seconds:.3f}s ({share:.1f}%)"
+            )
+
+class TermMatcher:
+    """
+    Matches Bulgarian 1 and Bulgarian 2 terms in one pass over the Anki rows.
+    Normalized keys and pipeline outcomes are memoized per term (and Part of Speech),
+    so terms shared between fields or repeated across cards are matched once.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.keys = {}
+        self.outcomes = {}
+
+    def key(self, term):
+        key = self.keys.get(term)
+        if key is None:
+            key = self.keys[term] = normalize_key(term)
+        return key
+
+    def match(self, term, part_of_speech):
+        cache_key = (term, part_of_speech)
+        outcome = self.outcomes.get(cache_key)
+        if outcome is None:
+            outcome = self.outcomes[cache_key] = self.pipeline.match(term, self.key(term), part_of_speech)
+        return outcome
+
+    @staticmethod
+    def same_word_key(fields):
+        """
+        The key a term matched, if it names the same word as the term: any level but the fuzzy
+        level 5, whose closest key may be a different word altogether.
+        """
+        if fields["Match Level"] == "5":
+            return None
+        return fields["Matched Key"]
+
+    def aspect_columns(self, term, fields):
+        """
+        Aspect columns for a term, looked up by its own key, then by the key it matched
+        (see same_word_key). A cutoff such as " се" removed before matching is put back on
+        the aspect forms.
+        """
+        aspect_index = self.pipeline.index.aspects
+        aspects = aspect_index.lookup(self.key(term))
+        suffix = ""
+        if aspects is None and self.same_word_key(fields):
+            aspects = aspect_index.lookup(self.same_word_key(fields))
+            suffix = fields["Cutoff Applied"] or ""
+        if aspects is None:
+            return dict.fromkeys(ASPECT_COLUMNS)
+        return {
+            "Aspect": aspects["aspect"],
+            "Imperfective Present": aspects["imperfective"] + suffix if "imperfective" in aspects else None,
+            "Perfective Present": aspects["perfective"] + suffix if "perfective" in aspects else None,
+        }
+
+    def inflection_columns(self, term, fields):
+        """
+        Noun and adjective form columns of the term itself, else of the lemma it matched
+        (see same_word_key).
+        """
+        inflection_index = self.pipeline.index.inflections
+        columns = inflection_index.columns(self.key(term))
+        if columns is None and self.same_word_key(fields):
+            columns = inflection_index.columns(self.same_word_key(fields))
+        return columns or dict.fromkeys(INFLECTION_COLUMNS)
+
+def match_row(anki_row, matcher):
+    """
+    Match both Bulgarian fields of a single Anki row.
+    Bulgarian 1 fills the plain result columns, Bulgarian 2 the columns suffixed " (Bulgarian 2)";
+    PONS Status 2 stays blank when Bulgarian 2 is blank.
+    Returns the result row and the queries of the matched entries for both fields.
+    """
+    bulgarian_1 = anki_row.bulgarian_1
+    bulgarian_2 = anki_row.bulgarian_2
+    part_of_speech = anki_row.part_of_speech
+
+    fields_1, pons_status_1, record_1 = matcher.match(bulgarian_1, part_of_speech)
+    if bulgarian_2:
+        fields_2, pons_status_2, record_2 = matcher.match(bulgarian_2, part_of_speech)
+    else:
+        fields_2, pons_status_2, record_2 = dict.fromkeys(RESULT_FIELD_COLUMNS), "", None
+
+    result = {
+        "Note ID": anki_row.note_id,
+        "Bulgarian 1": bulgarian_1,
+        "Part of Speech": part_of_speech,
+        "Bulgarian 2": bulgarian_2,
+    }
+    result.update(fields_1)
+    for column in RESULT_FIELD_COLUMNS:
+        result[f"{column}{BULGARIAN_2_SUFFIX}"] = fields_2[column]
+    result["PONS Status 1"] = pons_status_1
+    result["PONS Status 2"] = pons_status_2
+    result.update(record_1.translation_grid if record_1 else dict.fromkeys(TRANSLATION_GRID_COLUMNS))
+    result.update(matcher.aspect_columns(bulgarian_1, fields_1))
+    result.update(matcher.inflection_columns(bulgarian_1, fields_1))
+    return result, [record.query if record else None for record in (record_1, record_2)]
+
+def process_and_reconcile():
+    """
+    Processes entries from concatenated.json, reconciles them with Flashcards.xlsm,
+    and saves the combined results into the 'Results' worksheet of Flashcards.xlsm.
+    """
+    logging.info("Starting process_and_reconcile function.")
+
+    if not os.path.exists(concatenated_file_path):
+        logging.error(f"Concatenated JSON file not found at {concatenated_file_path}.")
+        return
+
+    if not os.path.exists(flashcards_xlsm_path):
+        logging.error(f"Flashcards.xlsm file not found at {flashcards_xlsm_path}.")
+        return
+
+    if not os.path.exists(anki_workbook_path):
+        logging.error(f"Anki workbook not found at {anki_workbook_path}.")
+        return
+
+    if validate_before_process:
+        validate_corpus()
+
+    try:
+        # Stream only the matching columns of the Anki sheet
+        try:
+            anki_data = load_anki_rows(anki_workbook_path, sheet_name="Anki")
+            logging.info(f"Collected {len(anki_data)} rows from Anki worksheet.")
+        except Exception as e:
+            logging.error(f"Error loading Anki sheet from {anki_workbook_path}: {e}", exc_info=True)
+            return
+
+        # The corpus is only loaded, and only parsed and compiled as a whole, once something needs it
+        corpus = {}
+
+        def concatenated_data():
+            if "data" not in corpus:
+                logging.info("Loading concatenated.json file.")
+                with open(concatenated_file_path, 'r', encoding='utf-8') as file:
+                    corpus["data"] = json.load(file)
+                logging.info(f"Loaded {len(corpus['data'])} entries from concatenated.json.")
+            return corpus["data"]
+
+        def all_records():
+            if "records" not in corpus:
+                corpus["records"] = compile_entries(load_parsed_corpus(concatenated_data()))
+                # The matcher only needs the compiled records from here on
+                corpus.pop("data", None)
+            return corpus["records"]
+
+        # Even a state that cannot be reused (other version or settings) still feeds the results diff
+        stored_state = read_reconcile_state() if incremental_reconcile or results_diff_enabled else None
+        previous_state = load_reconcile_state(stored_state) if incremental_reconcile and stored_state else None
+        corpus_file_fp = file_sha1(concatenated_file_path)
+
+        if previous_state and previous_state.get("corpus_file") == corpus_file_fp:
+            # concatenated.json is byte for byte the file of the last run, so are its fingerprints
+            entry_fingerprints = previous_state.get("entries", {})
+            corpus_fingerprint = previous_state.get("corpus")
+        else:
+            # Fingerprint every stored response; the first entry per query is the one the cascade matches
+            entry_fingerprints = {}
+            corpus_fingerprints = [entry_fingerprint(json_entry) for json_entry in concatenated_data()]
+            for json_entry, entry_fp in zip(concatenated_data(), corpus_fingerprints):
+                entry_fingerprints.setdefault(json_entry["query"], entry_fp)
+            corpus_fingerprint = fingerprint(corpus_fingerprints)
+            del corpus_fingerprints
+
+        if previous_state:
+            previous_entries = previous_state.get("entries", {})
+            previous_rows = previous_state.get("rows", {})
+            corpus_changed = previous_state.get("corpus") != corpus_fingerprint
+            # Normalized keys under which responses that are new or differ from the last run are indexed;
+            # only those entries are compiled, unless most of the corpus changed anyway
+            changed_queries = {
+                query for query, entry_fp in entry_fingerprints.items() if previous_entries.get(query) != entry_fp
+            }
+            if not changed_queries:
+                changed_records = []
+            elif len(changed_queries) * 2 > len(entry_fingerprints):
+                changed_records = [record for record in all_records() if record.query in changed_queries]
+            else:
+                changed_records = compile_selected_entries(concatenated_data(), changed_queries)
+            dirty_keys = {key for record in changed_records for key in record_index_keys(record)}
+            del changed_records
+        else:
+            previous_rows = {}
+            corpus_changed = True
+            dirty_keys = set()
+
+        state_rows = {}
+        progress = {"rows": 0, "reused": 0, "pipeline": None}
+        diff = ResultsDiff(stored_state.get("rows", {}) if stored_state else {}) if results_diff_enabled else None
+        stored_state = None
+        # Note keys of added or changed rows, for the delta_only_sinks
+        delta_notes = set()
+
+        def iter_results():
+            """
+            Yield one result per Anki row, reusing unchanged rows and matching the rest,
+            while collecting the reconcile state for the next run.
+            Rows are handled in batches of result_sink_batch_size so the hints of newly matched
+            rows are rendered together before they are stored or written.
+            """
+            matcher = None
+            renderer = load_hint_renderer()
+            for batch in iter_shards(anki_data, result_sink_batch_size):
+                batch_results = []
+                matched_results = []
+                for anki_row in batch:
+                    row_fp = row_fingerprint(anki_row)
+                    previous = previous_rows.get(str(anki_row.note_id))
+                    if previous and previous["row"] == row_fp and not row_needs_rematch(
+                            anki_row, previous, entry_fingerprints, dirty_keys, corpus_changed):
+                        result = previous["result"]
+                        matched_queries = previous["entries"]
+                        result_fp = previous.get("result_fp") or fingerprint(result)
+                        progress["reused"] += 1
+                    else:
+                        if matcher is None:
+                            progress["pipeline"] = MatchPipeline(MatchIndex(all_records()), match_strategy_order)
+                            matcher = TermMatcher(progress["pipeline"])
+                        result, matched_queries = match_row(anki_row, matcher)
+                        result_fp = None
+                        matched_results.append(result)
+                    batch_results.append((anki_row, row_fp, result, matched_queries, result_fp))
+                renderer.render_results(matched_results, HINT_RESULT_COLUMNS)
+
+                for anki_row, row_fp, result, matched_queries, result_fp in batch_results:
+                    if result_fp is None:
+                        result_fp = fingerprint(result)
+                    if anki_row.note_id is not None:
+                        note_key = str(anki_row.note_id)
+                        state_rows[note_key] = {
+                            "row": row_fp,
+                            "entries": matched_queries,
+                            "entry_fps": [entry_fingerprints.get(query) for query in matched_queries],
+                            "result": result,
+                            "result_fp": result_fp
+                        }
+                        if diff is not None and diff.record(note_key, result, result_fp):
+                            delta_notes.add(note_key)
+                    progress["rows"] += 1
+                    yield result
+
+        writeback = {}
+
+        def anki_writeback_edits(package):
+            """
+            Replacement for the Anki worksheet part carrying the new PONS column values.
+            Called once every result has been streamed, so state_rows is complete.
+            """
+            sheet_part = find_sheet_part(package, "Anki")
+            if sheet_part is None:
+                logging.warning("Sheet 'Anki' not found in Flashcards.xlsm; nothing written back.")
+                return {}
+            result_rows = {note_key: row["result"] for note_key, row in state_rows.items()}
+            writeback["sheet"] = AnkiSheetWriteback(package, sheet_part, writeback_values(result_rows))
+            return {sheet_part: writeback["sheet"].write}
+
+        package_edits = None
+        if anki_writeback:
+            if "xlsm" not in result_sinks:
+                logging.warning("Write-back is saved together with the Results sheet; add 'xlsm' to result_sinks.")
+            elif os.path.abspath(anki_workbook_path) == os.path.abspath(flashcards_xlsm_path):
+                package_edits = anki_writeback_edits
+            else:
+                logging.warning(f"Write-back needs the Anki sheet in {flashcards_xlsm_path}; skipped.")
+
+        def is_delta(result):
+            """
+            True for rows added or changed since the last run; rows without a Note ID always pass.
+            """
+            return result.get("Note ID") is None or str(result.get("Note ID")) in delta_notes
+
+        if delta_only_sinks and diff is None:
+            logging.warning("delta_only_sinks needs results_diff_enabled; all rows will be written.")
+            delta_only_sinks_active = []
+        else:
+            delta_only_sinks_active = delta_only_sinks
+
+        logging.info("Starting matching logic.")
+        # Stream results into every configured sink; rows are matched as the sinks consume them
+        closed_sinks = []
+        # The diff and reconcile state are the baseline of the next run's delta; they only
+        # advance once every configured sink holds this run's results
+        sinks_complete = False
+        try:
+            sinks = [
+                DeltaOnlySink(sink, is_delta, diff.removed_keys) if sink.name in delta_only_sinks_active else sink
+                for sink in open_result_sinks(package_edits, delta_only_sinks_active)
+            ]
+            closed_sinks = write_results(iter_results(), sinks)
+            xlsm_sink = next((getattr(sink, "sink", sink) for sink in sinks if sink.name == "xlsm"), None)
+            sinks_complete = len(closed_sinks) == len(result_sinks)
+            if diff is not None:
+                if sinks_complete:
+                    diff.finish()
+                else:
+                    diff.abort()
+            if "xlsm" in closed_sinks:
+                if "sheet" in writeback:
+                    logging.info(f"Write-back: updated {writeback['sheet'].changed_cells} cells in "
+                                 f"{writeback['sheet'].changed_rows} Anki rows; "
+                                 f"{writeback['sheet'].skipped_formulas} formula cells left untouched.")
+                if os.path.abspath(anki_workbook_path) == os.path.abspath(flashcards_xlsm_path):
+                    refresh_anki_snapshot_key(anki_workbook_path, xlsm_sink.source_crcs, sheet_name="Anki")
+        except Exception as e:
+            logging.error(f"Exception writing results: {e}", exc_info=True)
+            if diff is not None and not diff.file.closed:
+                diff.abort()
+
+        reused_rows = progress["reused"]
+        logging.info(f"Reused {reused_rows} of {progress['rows']} rows from the previous run; re-evaluated {progress['rows'] - reused_rows}.")
+
+        # A run that reused every row of the same notes over the same corpus file would write
+        # back the state it started from
+        state_unchanged = (
+            previous_state is not None
+            and progress["reused"] == progress["rows"]
+            and previous_state.get("corpus_file") == corpus_file_fp
+            and state_rows.keys() == previous_rows.keys()
+        )
+
+        # Only a complete pass leaves a state the next run can rely on
+        if not sinks_complete:
+            logging.warning("Not every result sink was written; the reconcile state is left at the previous run.")
+        elif state_unchanged:
+            logging.info("Reconcile state unchanged; not rewritten.")
+        elif progress["rows"] == len(anki_data):
+            try:
+                save_reconcile_state({
+                    "version": reconcile_state_version,
+                    "settings": reconcile_settings_fingerprint(),
+                    "corpus": corpus_fingerprint,
+                    "corpus_file": corpus_file_fp,
+                    "entries": entry_fingerprints,
+                    "rows": state_rows
+                })
+            except Exception as e:
+                logging.error(f"Exception saving reconcile state: {e}", exc_info=True)
+
+        # Log summary statistics
+        logging.info(f"Processing complete. Total rows: {len(anki_data)}. Results written to: {', '.join(closed_sinks) or 'none'}.")
+        if progress["pipeline"] is not None:
+            progress["pipeline"].log_summary()
+            render_cache = load_hint_renderer().render.cache_info()
+            logging.info(f"Hint rendering: {render_cache.misses} fragments rendered, {render_cache.hits} served from cache.")
+        else:
+            logging.info("Match pipeline: every row was reused from the previous run.")
+
+    except Exception as e:
+        logging.error(f"An error occurred in process_and_reconcile: {e}", exc_info=True)
+
+# Main workflow
+available_modes = {
+    "fetch": fetch_and_concatenate,
+    "process": process_and_reconcile,
+    "benchmark_readers": benchmark_anki_readers,
+    "expand_acronyms": expand_acronyms_in_corpus,
+    "extract_paths": extract_paths_from_corpus,
+    "profile_schema": profile_schema,
+    "validate": validate_corpus,
+    "query_facets": query_facets,
+}
+
+# Worker processes of profile_schema and validate_corpus import this script without running a mode
+if __name__ == "__main__":
+    setup_run()
+    if mode in available_modes:
+        logging.info(f"Main: Running {available_modes[mode].__name__}()")
+        available_modes[mode]()
+    else:
+        logging.error(f"Unknown mode: {mode}")
+        print(f"Unknown mode: {mode}")
+        print(f"Available modes: {', '.join(available_modes.keys())}")
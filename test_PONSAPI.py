@@ -0,0 +1,83 @@
+import PONSAPI
+
+
+def entry(query, headword_full, wordclass):
+    return {"query": query, "data": [{"lang": "bg", "hits": [{"type": "entry", "opendict": False, "roms": [{
+        "headword": query,
+        "headword_full": headword_full,
+        "wordclass": wordclass,
+        "arabs": [{"header": "", "translations": [{"source": query, "target": "to write"}]}],
+    }]}]}]}
+
+
+def verb_entry(query, headword_full):
+    return entry(query, headword_full, "verb")
+
+
+def make_matcher(concatenated_data):
+    records = PONSAPI.compile_entries(PONSAPI.parse_corpus(concatenated_data))
+    index = PONSAPI.MatchIndex(records)
+    return PONSAPI.TermMatcher(PONSAPI.MatchPipeline(index, PONSAPI.match_strategy_order))
+
+
+def test_fuzzy_match_keeps_aspect_of_the_card_verb():
+    # пиша lists напиша as its perfective partner; напиша itself is no stored query or headword
+    matcher = make_matcher([
+        verb_entry("пиша", 'пѝша <span class="conjugation"><acronym title="imperfective form">imperf</acronym></span>, '
+                           '<span class="headword">напѝша</span> '
+                           '<span class="conjugation"><acronym title="perfective form">perf</acronym></span>'),
+    ])
+    fields, _, _ = matcher.match("напиша", "verb")
+    assert fields["Match Level"] == "5"
+    assert fields["Matched Key"] == "пиша"
+    assert matcher.aspect_columns("напиша", fields) == {
+        "Aspect": "perfective",
+        "Imperfective Present": "пиша",
+        "Perfective Present": "напиша",
+    }
+
+
+def test_fuzzy_match_to_another_verb_leaves_aspect_and_forms_blank():
+    matcher = make_matcher([
+        verb_entry("пиша", 'пѝша <span class="conjugation"><acronym title="imperfective form">imperf</acronym></span>'),
+    ])
+    fields, _, _ = matcher.match("пия", "verb")
+    assert fields["Match Level"] == "5"
+    assert fields["Matched Key"] == "пиша"
+    assert matcher.aspect_columns("пия", fields) == dict.fromkeys(PONSAPI.ASPECT_COLUMNS)
+    assert matcher.inflection_columns("пия", fields) == dict.fromkeys(PONSAPI.INFLECTION_COLUMNS)
+
+
+def test_fuzzy_match_to_another_noun_leaves_forms_blank():
+    matcher = make_matcher([
+        entry("бедуин", 'бедуѝн <span class="flexion">&lt;-ът, -и&gt;</span> <span class="wordclass">noun</span> '
+                        '<span class="genus">masculine</span>', "noun"),
+    ])
+    fields, _, _ = matcher.match("бедуна", "noun")
+    assert fields["Match Level"] == "5"
+    assert fields["Matched Key"] == "бедуин"
+    assert matcher.inflection_columns("бедуна", fields) == dict.fromkeys(PONSAPI.INFLECTION_COLUMNS)
+    assert matcher.inflection_columns("бедуин", fields)["Noun Plural"] == "бедуини"
+
+
+def test_merge_ending():
+    assert PONSAPI.merge_ending("добър", "бра") == "добра"
+    assert PONSAPI.merge_ending("радост", "та") == "радостта"
+    assert PONSAPI.merge_ending("бедуин", "ът") == "бедуинът"
+    assert PONSAPI.merge_ending("нов", "кра") is None
+    assert PONSAPI.adjective_forms("до̀бър", "<-бра, -бро, -бри>", None, None)["Adjective Feminine"] == "добра"
+
+
+def test_translation_grid_strips_tags_whatever_the_hint_settings(monkeypatch):
+    monkeypatch.setattr(PONSAPI, "strip_hint_html", False)
+    PONSAPI.load_hint_renderer.cache_clear()
+    try:
+        json_entry = entry("пиша", "пѝша", "verb")
+        json_entry["data"][0]["hits"][0]["roms"][0]["arabs"][0]["translations"][0]["target"] = (
+            'to write <span class="style">formal</span> &amp; more'
+        )
+        record = PONSAPI.compile_entries(PONSAPI.parse_corpus([json_entry]))[0]
+        assert PONSAPI.load_hint_renderer().render("<b>x</b>") == "<b>x</b>"
+        assert record.translation_grid[PONSAPI.TRANSLATION_GRID_COLUMNS[0]] == "to write formal & more"
+    finally:
+        PONSAPI.load_hint_renderer.cache_clear()